@@ -0,0 +1,472 @@
+"""Benchmarks ingest by the Strava Activities input and the webhook receiver against the mock Strava API.
+
+Build the add-on with ucc-gen first, so the modular inputs can import their libraries, and run for example:
+
+    python benchmarks/benchmark.py ingest --activities 200 --points 3600 --arg fetch_workers=4
+    python benchmarks/benchmark.py webhook --events 2000 --clients 16
+    python benchmarks/benchmark.py coalesce --events 100 --arg direct_fetch=1
+    python benchmarks/benchmark.py parse --points 20000
+    python benchmarks/benchmark.py https --activities 200 --arg fetch_workers=4
+
+Every scenario runs in its own process, so the peak memory of one doesn't carry over into the next.
+"""
+import argparse
+import http.client
+import json
+import os
+import resource
+import shutil
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_APP = os.path.join(REPO, 'output', 'TA-strava-for-splunk')
+SCENARIOS = ('ingest', 'replay', 'webhook', 'coalesce', 'parse', 'https')
+# Runs of each transform in the parse scenario, the fastest one counts
+PARSE_REPEATS = 3
+ATHLETE_ID = 1001
+
+
+def load_modules(app):
+    """Imports the add-on from its build output, and replaces its HTTP client and splunkd connections with the mock."""
+    sys.path.insert(0, os.path.join(app, 'bin'))
+    import mock_strava  # pylint: disable=import-outside-toplevel
+    import strava_api  # pylint: disable=import-outside-toplevel
+    import strava_webhook  # pylint: disable=import-outside-toplevel
+
+    strava_api.HttpClient = strava_webhook.HttpClient = mock_strava.MockHttpClient
+    strava_api.client.connect = strava_webhook.client.connect = mock_strava.connect
+    # Retries of injected server errors shouldn't make the benchmark mostly about sleeping
+    strava_api.BACKOFF_BASE = 0.05
+    strava_api.BACKOFF_CAP = 1
+    return mock_strava, strava_api, strava_webhook
+
+
+def key_values(pairs):
+    """Parses key=value pairs from the command line into a dict."""
+    return dict(pair.split('=', 1) for pair in pairs or [])
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, ru_maxrss is in KB on Linux and bytes on macOS."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_ingest(options, work_dir, replay=False):
+    """Runs the Strava Activities input for one athlete from the start, returns its throughput and API usage.
+
+    With replay, the input runs twice and the second run, which gets the same activities again, is measured.
+    """
+    mock_strava, strava_api, _ = load_modules(options.app)
+    athlete = mock_strava.Athlete(ATHLETE_ID, activities=options.activities, points=options.points)
+    mock = mock_strava.MockHttpClient.mock = mock_strava.MockStrava([athlete], latency=options.latency, error_rate=options.error_rate, throttle_rate=options.throttle_rate)
+    args = dict({'access_code': str(ATHLETE_ID), 'start_time': '0', 'interval': '3600'}, **key_values(options.arg))
+    helper = mock_strava.Helper('athlete1', 'strava_api', args=args, settings=dict({'client_id': '1', 'client_secret': 'secret'}, **key_values(options.setting)), checkpoint_dir=os.path.join(work_dir, 'checkpoints'))
+
+    if replay:
+        strava_api.StravaApi.collect_events(helper, mock_strava.EventWriter())
+        helper.checkpoints['athlete1']['ts_activity'] = 0
+        mock.calls.clear()
+        mock.points_served = 0
+        mock.activities_listed = 0
+        helper.logs.clear()
+        helper.checkpoint_writes = 0
+
+    event_writer = mock_strava.EventWriter()
+    started = time.perf_counter()
+    strava_api.StravaApi.collect_events(helper, event_writer)
+    elapsed = time.perf_counter() - started
+
+    activities = mock.activities_listed
+    return {
+        'scenario': 'replay' if replay else 'ingest',
+        'seconds': round(elapsed, 3),
+        'activities': activities,
+        'activities_per_second': round(activities / elapsed, 1),
+        'activities_written': event_writer.sourcetypes['strava:activities'],
+        'stream_points': mock.points_served,
+        'stream_points_per_second': round(mock.points_served / elapsed),
+        'events': event_writer.count,
+        'events_per_second': round(event_writer.count / elapsed),
+        'api_calls': mock.strava_calls(),
+        'api_calls_per_activity': round(mock.strava_calls() / max(activities, 1), 2),
+        'checkpoint_writes': helper.checkpoint_writes,
+        'checkpoint_writes_per_activity': round(helper.checkpoint_writes / max(activities, 1), 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'calls': dict(mock.calls),
+        'logs': dict(helper.logs),
+    }
+
+
+def create_certificate(work_dir):
+    """Creates a self-signed certificate for localhost, returns the certificate and key file."""
+    cert_file = os.path.join(work_dir, 'cert.pem')
+    key_file = os.path.join(work_dir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost', '-days', '1',
+                    '-keyout', key_file, '-out', cert_file], check=True, capture_output=True)
+    return cert_file, key_file
+
+
+def start_webhook(options, work_dir, mock_strava, strava_webhook, athlete):
+    """Starts the webhook receiver for the athlete against the mock, returns the mock, helper, event writer and receiving servers."""
+    mock = mock_strava.MockHttpClient.mock = mock_strava.MockStrava([athlete], latency=options.latency, error_rate=options.error_rate, throttle_rate=options.throttle_rate)
+    mock.subscriptions = [{'id': 1, 'callback_url': 'https://localhost/'}]
+
+    # The athlete's Strava Activities input, which direct fetch looks up to get the athlete's token and settings
+    checkpoints = {'athlete1': {'id': ATHLETE_ID, 'name': 'Mock Athlete', 'ts_activity': 0}}
+    mock.inputs = [{'name': 'athlete1', 'content': {'index': 'strava'}}]
+    mock_strava.Service.storage_passwords.create(json.dumps({'access_token': f'token-{ATHLETE_ID}', 'refresh_token': f'refresh-{ATHLETE_ID}', 'expires_at': int(time.time()) + 21600}), 'athlete1')
+
+    cert_file, key_file = create_certificate(work_dir)
+
+    args = dict({'port': str(options.port), 'verify_token': 'benchmark', 'cert_file': cert_file, 'key_file': key_file, 'callback_url': 'https://localhost/', 'reload_delay': '1'}, **key_values(options.arg))
+    helper = mock_strava.Helper('webhook', 'strava_webhook', args=args, settings={'client_id': '1', 'client_secret': 'secret'}, checkpoints=checkpoints, checkpoint_dir=os.path.join(work_dir, 'checkpoints'), per_stanza=True)
+
+    # Keep hold of the server, so it can be shut down at the end
+    servers = []
+
+    class ThreadingHTTPServer(strava_webhook.ThreadingHTTPServer):  # pylint: disable=too-few-public-methods
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            servers.append(self)
+
+    strava_webhook.ThreadingHTTPServer = ThreadingHTTPServer
+    event_writer = mock_strava.EventWriter()
+    strava_webhook.StravaWebhook.collect_events(helper, event_writer)
+    return mock, helper, event_writer, servers
+
+
+def post_events(options, messages):
+    """Posts the events from several clients, each on a new connection like Strava does. Returns the status and the time until it was acknowledged of each."""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+
+    def post(message):
+        started = time.perf_counter()
+        connection = http.client.HTTPSConnection('127.0.0.1', options.port, context=context, timeout=10)
+        try:
+            connection.request('POST', '/', json.dumps(message), {'Content-Type': 'application/json'})
+            status = connection.getresponse().status
+        finally:
+            connection.close()
+        return status, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=options.clients) as executor:
+        return list(executor.map(post, messages))
+
+
+def update_event(activity_id, index):
+    """Returns a webhook event for an update of the title of an activity."""
+    return {'aspect_type': 'update', 'event_time': int(time.time()), 'object_id': activity_id, 'object_type': 'activity', 'owner_id': ATHLETE_ID,
+            'subscription_id': 1, 'updates': {'title': f'Update {index}'}}
+
+
+def wait_for(condition, timeout):
+    """Waits until condition returns True or timeout seconds have passed, returns whether it did."""
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def run_webhook(options, work_dir):
+    """Starts the webhook receiver and posts activity updates to it from several clients, returns how fast they're handled."""
+    mock_strava, _, strava_webhook = load_modules(options.app)
+    athlete = mock_strava.Athlete(ATHLETE_ID, activities=options.activities, points=options.points)
+    mock, helper, event_writer, servers = start_webhook(options, work_dir, mock_strava, strava_webhook, athlete)
+    activity_ids = [activity['id'] for activity in athlete.activities]
+    # Every fourth event is a new activity
+    messages = [dict(update_event(activity_ids[index % len(activity_ids)], index), aspect_type='update' if index % 4 else 'create') for index in range(options.events)]
+
+    started = time.perf_counter()
+    results = post_events(options, messages)
+    received = time.perf_counter() - started
+    acknowledged = sum(status == 200 for status, _ in results)
+    # Every acknowledged event is written to Splunk by the workers once it has been handled
+    wait_for(lambda: event_writer.sourcetypes['strava:webhook'] >= acknowledged, options.timeout)
+    processed = time.perf_counter() - started
+    # With direct fetch, every updated activity is written once its events have settled
+    fetched = None
+    if key_values(options.arg).get('direct_fetch') == '1':
+        targets = len({message['object_id'] for message in messages})
+        wait_for(lambda: event_writer.sourcetypes['strava:activities'] >= targets, options.timeout)
+        fetched = time.perf_counter() - started - received
+    for server in servers:
+        server.shutdown()
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'scenario': 'webhook',
+        'events': options.events,
+        'acknowledged': acknowledged,
+        'received_per_second': round(options.events / received, 1),
+        'processed': event_writer.sourcetypes['strava:webhook'],
+        'processed_per_second': round(event_writer.sourcetypes['strava:webhook'] / processed, 1),
+        'ack_ms_median': round(statistics.median(latencies) * 1000, 1),
+        'ack_ms_p95': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        'searchable_s': round(fetched, 2) if fetched is not None else None,
+        'api_calls': mock.strava_calls(),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'calls': dict(mock.calls),
+        'logs': dict(helper.logs),
+    }
+
+
+def run_coalesce(options, work_dir):
+    """Posts all events as updates of a single activity, which should be queued once, reload the input once and be fetched once.
+
+    Without direct fetch, the athlete's Strava Activities input runs after the reload to get the queued update.
+    """
+    mock_strava, strava_api, strava_webhook = load_modules(options.app)
+    athlete = mock_strava.Athlete(ATHLETE_ID, activities=options.activities, points=options.points)
+    mock, helper, event_writer, servers = start_webhook(options, work_dir, mock_strava, strava_webhook, athlete)
+    activity_id = athlete.activities[0]['id']
+    direct_fetch = key_values(options.arg).get('direct_fetch') == '1'
+
+    def reloads():
+        return sum(count for endpoint, count in mock.calls.items() if endpoint.endswith('/_reload'))
+
+    results = post_events(options, [update_event(activity_id, index) for index in range(options.events)])
+    acknowledged = sum(status == 200 for status, _ in results)
+    wait_for(lambda: event_writer.sourcetypes['strava:webhook'] >= acknowledged, options.timeout)
+    if direct_fetch:
+        wait_for(lambda: event_writer.sourcetypes['strava:activities'], options.timeout)
+    else:
+        wait_for(reloads, options.timeout)
+    # Anything else the burst would cause happens within the reload delay of 1 second
+    time.sleep(2)
+    for server in servers:
+        server.shutdown()
+    queued = len(mock.kvstore['strava_webhook_updates'])
+
+    if not direct_fetch:
+        # The reloaded input only has the queued update to get, its other activities are older than its checkpoint
+        checkpoints = {'athlete1': dict(helper.checkpoints['athlete1'], ts_activity=int(time.time()))}
+        input_helper = mock_strava.Helper('athlete1', 'strava_api', args={'start_time': '0', 'interval': '3600'}, settings={'client_id': '1', 'client_secret': 'secret'},
+                                          checkpoints=checkpoints, checkpoint_dir=os.path.join(work_dir, 'checkpoints'))
+        strava_api.StravaApi.collect_events(input_helper, event_writer)
+
+    fetches = mock.calls['GET /api/v3/activities/{id}']
+    return {
+        'scenario': 'coalesce',
+        'events': options.events,
+        'acknowledged': acknowledged,
+        'queued_updates': queued,
+        'input_reloads': reloads(),
+        'activity_fetches': fetches,
+        'left_in_queue': len(mock.kvstore['strava_webhook_updates']),
+        # Direct fetch doesn't queue the update or reload the input
+        'coalesced': fetches == 1 and queued == reloads() == (0 if direct_fetch else 1),
+        'api_calls': mock.strava_calls(),
+        'calls': dict(mock.calls),
+        'logs': dict(helper.logs),
+    }
+
+
+def run_https(options, work_dir):  # pylint: disable=too-many-locals
+    """Gets the details of every activity from a local HTTPS stand-in of Strava, with the pooled HTTP client and with a new session per request.
+
+    A proxy in front of the server counts the connections each opens and the bytes transferred, TLS handshakes included.
+    """
+    mock_strava, _, _ = load_modules(options.app)
+    import requests  # pylint: disable=import-outside-toplevel
+    import strava_http  # pylint: disable=import-outside-toplevel
+
+    athlete = mock_strava.Athlete(ATHLETE_ID, activities=options.activities, points=options.points)
+    mock = mock_strava.MockStrava([athlete], latency=options.latency)
+    cert_file, key_file = create_certificate(work_dir)
+    server = mock_strava.HttpsServer(mock, cert_file, key_file)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    workers = int(key_values(options.arg).get('fetch_workers') or 4)
+    headers = {'Authorization': f'Bearer token-{ATHLETE_ID}'}
+
+    results = {}
+    for name in ('per_request', 'pooled'):
+        proxy = mock_strava.CountingProxy(server.server_address)
+        http_client = strava_http.HttpClient(pool_size=workers) if name == 'pooled' else None
+
+        def get(activity, http_client=http_client, port=proxy.port):
+            url = f"https://localhost:{port}/api/v3/activities/{activity['id']}"
+            if http_client:
+                response = http_client.send_http_request(url, 'GET', headers=headers, verify=cert_file)
+            else:
+                response = requests.request('GET', url, headers=headers, verify=cert_file, timeout=10)
+            response.raise_for_status()
+            return len(response.content)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            body_bytes = sum(executor.map(get, athlete.activities))
+        seconds = time.perf_counter() - started
+        if http_client:
+            http_client.close()
+        proxy.close()
+        results[name] = {'connections': proxy.connections, 'kb': proxy.bytes / 1024, 'seconds': seconds}
+    server.shutdown()
+
+    return {
+        'scenario': 'https',
+        'requests': len(athlete.activities),
+        'workers': workers,
+        'body_kb': round(body_bytes / 1024, 1),
+        'per_request_connections': results['per_request']['connections'],
+        'pooled_connections': results['pooled']['connections'],
+        'per_request_kb': round(results['per_request']['kb'], 1),
+        'pooled_kb': round(results['pooled']['kb'], 1),
+        'per_request_seconds': round(results['per_request']['seconds'], 3),
+        'pooled_seconds': round(results['pooled']['seconds'], 3),
+    }
+
+
+def legacy_parse_data(data, activity_id, activity_start_date):
+    """The transform of streams into events from before 3.3.0, a dict of dicts per point. Returns the events as written."""
+    data_dict = {}
+    final_dict = {}
+    for i in data:
+        data_dict[i['type']] = i['data']
+
+    counter = 1
+    nrange = len(data_dict['time'])
+    for item in range(1, nrange + 1):
+        final_dict[item] = {}
+
+    for key, value in data_dict.items():
+        counter = 1
+        for i in value:
+            final_dict[counter][key] = i
+            final_dict[counter]['activity_id'] = activity_id
+
+            if 'time' in key:
+                final_dict[counter]['time'] = final_dict[counter]['time'] + activity_start_date
+                final_dict[counter]['time'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(final_dict[counter]['time']))
+
+            if 'latlng' in key:
+                final_dict[counter]['lat'] = final_dict[counter]['latlng'][0]
+                final_dict[counter]['lon'] = final_dict[counter]['latlng'][1]
+                final_dict[counter].pop('latlng')
+            counter += 1
+
+    return [json.dumps(value) for value in final_dict.values()]
+
+
+def run_parse(options, work_dir):  # pylint: disable=unused-argument
+    """Turns the streams of one activity into events with the transform from before 3.3.0 and the current one, returns how long each takes."""
+    mock_strava, _, _ = load_modules(options.app)
+    import strava_streams  # pylint: disable=import-outside-toplevel
+
+    athlete = mock_strava.Athlete(ATHLETE_ID, activities=1, points=options.points)
+    activity = athlete.activities[0]
+    _, chunks = athlete.streams(activity['id'], strava_streams.STREAM_TYPES)
+    data = json.loads(b''.join(chunks))
+    start = mock_strava.epoch(activity['start_date'])
+
+    def current():
+        epochs, columns = strava_streams.get_stream_columns(data, start)
+        _, events = strava_streams.build_events(epochs, columns, activity['id'], ATHLETE_ID)
+        return [json.dumps(event) for event in events]
+
+    # Best of PARSE_REPEATS runs, so a garbage collection during one run doesn't count
+    timings = {}
+    results = {}
+    for name, transform in (('legacy', lambda: legacy_parse_data(data, activity['id'], start)), ('current', current)):
+        seconds = []
+        for _ in range(PARSE_REPEATS):
+            started = time.perf_counter()
+            events = transform()
+            seconds.append(time.perf_counter() - started)
+        timings[name] = min(seconds)
+        results[name] = [json.loads(event) for event in events]
+
+    return {
+        'scenario': 'parse',
+        'points': options.points,
+        'streams': len(data),
+        'legacy_seconds': round(timings['legacy'], 3),
+        'current_seconds': round(timings['current'], 3),
+        'events': len(results['current']),
+        # Both write the same fields for every point, in a different order
+        'same_events': results['legacy'] == results['current'],
+        'speedup': round(timings['legacy'] / timings['current'], 2),
+        'numpy': strava_streams.np is not None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def run_scenario(options):
+    """Runs a single scenario in this process and prints its results as JSON."""
+    work_dir = tempfile.mkdtemp(prefix='strava-benchmark-')
+    try:
+        if options.scenario == 'webhook':
+            result = run_webhook(options, work_dir)
+        elif options.scenario == 'coalesce':
+            result = run_coalesce(options, work_dir)
+        elif options.scenario == 'parse':
+            result = run_parse(options, work_dir)
+        elif options.scenario == 'https':
+            result = run_https(options, work_dir)
+        else:
+            result = run_ingest(options, work_dir, replay=options.scenario == 'replay')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help=f'Scenarios to run: {", ".join(SCENARIOS)}. All of them by default.')
+    parser.add_argument('--app', default=DEFAULT_APP, help='Build output of the add-on (default: %(default)s).')
+    parser.add_argument('--activities', type=int, default=100, help='Activities of the synthetic athlete.')
+    parser.add_argument('--points', type=int, default=3600, help='Stream points of every activity.')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every Strava API response.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of Strava API responses that are a 500 error.')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Share of Strava API responses that are a 429 error.')
+    parser.add_argument('--arg', action='append', metavar='NAME=VALUE', help='Input argument, e.g. fetch_workers=4 or stream_format=packed. Can be repeated.')
+    parser.add_argument('--setting', action='append', metavar='NAME=VALUE', help='Add-on setting, e.g. response_cache_size=100. Can be repeated.')
+    parser.add_argument('--events', type=int, default=1000, help='Webhook events to post.')
+    parser.add_argument('--clients', type=int, default=8, help='Clients posting webhook events at the same time.')
+    parser.add_argument('--port', type=int, default=18443, help='Port of the webhook receiver.')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for webhook events to be handled.')
+    parser.add_argument('--json', action='store_true', help='Print the full results as JSON lines.')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.scenario:
+        run_scenario(options)
+        return
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    # Every scenario runs in a new process with the same options
+    forwarded = [argument for argument in sys.argv[1:] if argument not in SCENARIOS]
+    for scenario in options.scenarios or SCENARIOS:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', scenario, *forwarded], capture_output=True, text=True, check=False)
+        if process.returncode:
+            sys.exit(f'Scenario {scenario} failed:\n{process.stderr}')
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        if options.json:
+            print(json.dumps(result))
+            continue
+        print(f"{result.pop('scenario')}:")
+        # The parse and https scenarios don't count requests by endpoint
+        calls = result.pop('calls', None)
+        logs = result.pop('logs', None)
+        for name, value in result.items():
+            print(f'  {name:<30} {value}')
+        if calls is not None:
+            print(f"  {'calls':<30} {', '.join(f'{endpoint}: {count}' for endpoint, count in sorted(calls.items()))}")
+            print(f"  {'log messages':<30} {', '.join(f'{level}: {count}' for level, count in sorted(logs.items()))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,556 @@
+"""Offline stand-in for the Strava v3 API and the parts of splunkd the add-on uses, for benchmarking without Strava or Splunk.
+
+Requests are answered in process by a requests transport adapter that is mounted on the add-on's pooled HTTP client,
+so the add-on's own retries, rate limit handling and JSON parsing run exactly as they do against Strava. HttpsServer
+serves the same API over HTTPS on localhost, to measure connections and bytes on the wire.
+"""
+import calendar
+import collections
+import gzip
+import http
+import io
+import json
+import math
+import random
+import re
+import socket
+import ssl
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from strava_http import HttpClient
+from strava_streams import STREAM_TYPES
+
+# Activities start at 2020-01-01, one a day
+FIRST_ACTIVITY = 1577836800
+# Points returned for the low and medium stream resolutions, high returns every point
+RESOLUTION_POINTS = {'low': 100, 'medium': 1000}
+# Stream points generated at a time while a streams response is read
+STREAM_CHUNK_POINTS = 2000
+KVSTORE_PATH = re.compile(r'/storage/collections/data/(?P<collection>[^/]+)(?P<batch_save>/batch_save)?$')
+ACTIVITY_PATH = re.compile(r'/api/v3/activities/(?P<activity_id>\d+)(?P<streams>/streams/(?P<types>[^/]*))?$')
+
+
+class Athlete:
+    """A synthetic athlete with a daily activity of a number of stream points, the same for the same seed."""
+
+    def __init__(self, athlete_id, activities=100, points=3600, seed=None):
+        self.id = athlete_id
+        self.points = points
+        self.random = random.Random(athlete_id if seed is None else seed)
+        self.activities = [self.summary(index) for index in range(activities)]
+        self.by_id = {activity['id']: activity for activity in self.activities}
+
+    def details(self, activity_id):
+        """Returns the details of an activity, or None if the athlete doesn't have it."""
+        summary = self.by_id.get(activity_id)
+        if summary is None:
+            return None
+        return dict(summary, resource_state=3, calories=summary['moving_time'] / 4, description='', segment_efforts=[], splits_metric=[], laps=[])
+
+    def streams(self, activity_id, stream_types, resolution='high', key_by_type=False):
+        """Returns the number of points and the JSON body of the requested streams of an activity in chunks, or None if the
+        athlete doesn't have the activity. The body is generated while it's read, so the mock's memory use doesn't grow
+        with the length of the activity. With key_by_type, the streams are an object keyed by type instead of a list.
+
+        The activity is a ride going round in a circle, with some noise on the speed, heart rate, cadence and power.
+        """
+        if activity_id not in self.by_id:
+            return None
+        count = min(self.points, RESOLUTION_POINTS.get(resolution, self.points))
+        step = self.points / count
+        lat, lng = self.by_id[activity_id]['start_latlng']
+        noise = random.Random(activity_id)
+        values = {
+            'time': lambda offset: offset,
+            'distance': lambda offset: round(offset * 8.0, 1),
+            'latlng': lambda offset: [round(lat + 0.02 * math.sin(offset / 600), 6), round(lng + 0.03 * math.cos(offset / 600), 6)],
+            'altitude': lambda offset: round(50 + 20 * math.sin(offset / 300), 1),
+            'velocity_smooth': lambda offset: round(8 + noise.uniform(-1, 1), 2),
+            'heartrate': lambda offset: noise.randint(120, 170),
+            'cadence': lambda offset: noise.randint(80, 95),
+            'watts': lambda offset: noise.randint(150, 260),
+            'temp': lambda offset: 18,
+            'moving': lambda offset: True,
+            'grade_smooth': lambda offset: round(2 * math.cos(offset / 300), 1),
+        }
+        requested = [stream_type for stream_type in stream_types if stream_type in values]
+
+        def chunks():
+            yield b'{' if key_by_type else b'['
+            for number, stream_type in enumerate(requested):
+                key = f'"{stream_type}":{{' if key_by_type else f'{{"type":"{stream_type}",'
+                yield f'{"," if number else ""}{key}"data":['.encode('utf-8')
+                for start in range(0, count, STREAM_CHUNK_POINTS):
+                    batch = [values[stream_type](int(index * step)) for index in range(start, min(start + STREAM_CHUNK_POINTS, count))]
+                    yield (',' if start else '').encode('utf-8') + json.dumps(batch, separators=(',', ':'))[1:-1].encode('utf-8')
+                yield f'],"series_type":"time","original_size":{self.points},"resolution":"{resolution}"}}'.encode('utf-8')
+            yield b'}' if key_by_type else b']'
+
+        return count, chunks()
+
+    def summary(self, index):
+        """Returns the summary of the athlete's activity with the given index, as listed by /activities."""
+        start = FIRST_ACTIVITY + index * 86400 + self.random.randint(6, 18) * 3600
+        return {
+            'id': self.id * 1000000 + index,
+            'resource_state': 2,
+            'athlete': {'id': self.id, 'resource_state': 1},
+            'name': f'Ride {index}',
+            'type': 'Ride',
+            'sport_type': 'Ride',
+            'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start)),
+            'distance': self.points * 8.0,
+            'moving_time': self.points,
+            'elapsed_time': self.points + self.random.randint(0, 600),
+            'total_elevation_gain': float(self.random.randint(0, 500)),
+            'average_watts': float(self.random.randint(150, 260)),
+            'device_name': 'Mock Strava device',
+            'start_latlng': [round(51.5 + self.random.uniform(-0.5, 0.5), 6), round(-0.1 + self.random.uniform(-0.5, 0.5), 6)],
+        }
+
+
+class MockStrava(BaseAdapter):  # pylint: disable=too-many-instance-attributes
+    """Answers requests to www.strava.com with the synthetic athletes, and requests to splunkd with an in-memory KV Store.
+
+    Faults are injected into Strava responses at random: latency seconds of delay for every request, a share of
+    error_rate 500 responses and a share of throttle_rate 429 responses. Usage is counted against the overall rate limits
+    and, for GET requests, the lower read limits, returned in the X-RateLimit and X-ReadRateLimit headers like Strava
+    does. Requests over either limit get a 429.
+    """
+
+    def __init__(self, athletes, latency=0, error_rate=0, throttle_rate=0, limits=(60000, 3000000), read_limits=(30000, 1500000), seed=0):  # pylint: disable=too-many-arguments
+        super().__init__()
+        self.athletes = {athlete.id: athlete for athlete in athletes}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.limits = limits
+        self.read_limits = read_limits
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Requests per endpoint, e.g. 'GET /api/v3/activities/{id}'
+        self.calls = collections.Counter()
+        self.usage = 0
+        self.read_usage = 0
+        self.points_served = 0
+        self.activities_listed = 0
+        self.kvstore = collections.defaultdict(dict)
+        self.subscriptions = []
+        # Entries of the strava_api inputs listed by splunkd, with their settings as content
+        self.inputs = []
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):  # pylint: disable=unused-argument
+        """Returns the response to a prepared request."""
+        url = urlparse(request.url)
+        body = request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body
+        if url.hostname == 'www.strava.com':
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                self.usage += 1
+                self.read_usage += request.method == 'GET'
+                fault = self.random.random()
+                exceeded = self.usage > min(self.limits) or (request.method == 'GET' and self.read_usage > min(self.read_limits))
+            if exceeded:
+                status, data = 429, {'message': 'Rate Limit Exceeded', 'errors': [{'resource': 'Application', 'code': 'exceeded'}]}
+                self.count(request.method, re.sub(r'/activities/\d+(/streams)?.*$', r'/activities/{id}\1', url.path) + f' ({status})')
+            elif fault < self.throttle_rate + self.error_rate:
+                if fault < self.throttle_rate:
+                    status, data = 429, {'message': 'Rate Limit Exceeded', 'errors': [{'resource': 'Application', 'code': 'exceeded'}]}
+                else:
+                    status, data = 500, {'message': 'Internal Server Error'}
+                self.count(request.method, re.sub(r'/activities/\d+(/streams)?.*$', r'/activities/{id}\1', url.path) + f' ({status})')
+            else:
+                status, data = self.strava(request.method, url, body, request.headers)
+            headers = {'X-RateLimit-Limit': f'{self.limits[0]},{self.limits[1]}', 'X-RateLimit-Usage': f'{self.usage},{self.usage}',
+                       'X-ReadRateLimit-Limit': f'{self.read_limits[0]},{self.read_limits[1]}', 'X-ReadRateLimit-Usage': f'{self.read_usage},{self.read_usage}'}
+        else:
+            status, data = self.splunkd(request.method, url, body)
+            headers = {}
+        return self.response(request, status, data, headers)
+
+    def count(self, method, endpoint):
+        with self.lock:
+            self.calls[f'{method} {endpoint}'] += 1
+
+    @staticmethod
+    def response(request, status, data, headers):
+        """Builds a requests response with a JSON body. A generator of chunks is read from as the response is consumed."""
+        response = requests.Response()
+        response.status_code = status
+        response.reason = http.HTTPStatus(status).phrase
+        if isinstance(data, types.GeneratorType):
+            response.raw = ChunkReader(data)
+        else:
+            # The body is read already, raw is there so the response can be closed like a real one
+            response._content = json.dumps(data).encode('utf-8')  # pylint: disable=protected-access
+            response.raw = io.BytesIO(response._content)  # pylint: disable=protected-access
+        response.headers = CaseInsensitiveDict(dict(headers, **{'Content-Type': 'application/json'}))
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def splunkd(self, method, url, body):
+        """Handles the KV Store, input and reload endpoints of splunkd."""
+        match = KVSTORE_PATH.search(url.path)
+        if match:
+            self.count(method, '/storage/collections/data/{collection}' + (match['batch_save'] or ''))
+            documents = self.kvstore[match['collection']]
+            if match['batch_save']:
+                saved = json.loads(body)
+                with self.lock:
+                    documents.update((str(document['_key']), document) for document in saved)
+                return 200, [document['_key'] for document in saved]
+            query = json.loads(parse_qs(url.query).get('query', ['{}'])[0])
+            with self.lock:
+                matching = [key for key, document in documents.items() if matches(document, query)]
+                if method == 'DELETE':
+                    for key in matching:
+                        del documents[key]
+                    return 200, None
+                return 200, [documents[key] for key in matching]
+        self.count(method, re.sub(r'/strava_api/[^/]+', '/strava_api/{stanza}', url.path))
+        if url.path.endswith('/data/inputs/strava_api'):
+            return 200, {'entry': self.inputs}
+        return 200, {}
+
+    def strava(self, method, url, body, headers):  # pylint: disable=too-many-return-statements
+        """Handles the Strava v3 endpoints the add-on uses. Access tokens are 'token-<athlete ID>'."""
+        athlete = self.athletes.get(int(headers.get('Authorization', 'Bearer token-0').rsplit('-', 1)[-1]))
+        path = url.path
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if path == '/api/v3/oauth/token':
+            self.count(method, path)
+            payload = json.loads(body) if body and body.startswith('{') else {key: values[0] for key, values in parse_qs(body or '').items()}
+            # The access code or refresh token of an athlete is their athlete ID
+            athlete = self.athletes.get(int(re.sub(r'\D', '', payload.get('code') or payload.get('refresh_token') or '') or 0))
+            if athlete is None:
+                return 400, {'message': 'Bad Request', 'errors': [{'resource': 'AuthorizationCode', 'code': 'invalid'}]}
+            return 200, {
+                'token_type': 'Bearer',
+                'access_token': f'token-{athlete.id}',
+                'refresh_token': f'refresh-{athlete.id}',
+                'expires_at': int(time.time()) + 21600,
+                'athlete': {'id': athlete.id, 'firstname': 'Mock', 'lastname': f'Athlete {athlete.id}'}}
+
+        if path == '/api/v3/push_subscriptions':
+            self.count(method, path)
+            if method == 'POST':
+                self.subscriptions = [{'id': 1, 'callback_url': json.loads(body).get('callback_url')}]
+                return 201, self.subscriptions[0]
+            return 200, self.subscriptions
+
+        if athlete is None:
+            self.count(method, path)
+            return 401, {'message': 'Authorization Error', 'errors': [{'resource': 'Athlete', 'code': 'invalid'}]}
+
+        if path == '/api/v3/athlete':
+            self.count(method, path)
+            return 200, {'id': athlete.id, 'resource_state': 3, 'firstname': 'Mock', 'lastname': f'Athlete {athlete.id}', 'weight': 70.0, 'ftp': 250}
+
+        if path == '/api/v3/activities':
+            self.count(method, path)
+            after = int(params.get('after', 0))
+            before = int(params.get('before', 1 << 62))
+            page = int(params.get('page', 1))
+            per_page = int(params.get('per_page', 30))
+            listed = [activity for activity in athlete.activities if after < epoch(activity['start_date']) < before]
+            listed = listed[(page - 1) * per_page:page * per_page]
+            with self.lock:
+                self.activities_listed += len(listed)
+            return 200, listed
+
+        match = ACTIVITY_PATH.search(path)
+        if match and match['streams']:
+            self.count(method, '/api/v3/activities/{id}/streams')
+            stream_types = match['types']
+            streams = athlete.streams(int(match['activity_id']), stream_types.split(',') if stream_types else STREAM_TYPES, params.get('resolution', 'high'), params.get('key_by_type') == 'true')
+            if streams is None:
+                return 404, {'message': 'Record Not Found'}
+            points, chunks = streams
+            with self.lock:
+                self.points_served += points
+            return 200, chunks
+        if match:
+            self.count(method, '/api/v3/activities/{id}')
+            details = athlete.details(int(match['activity_id']))
+            return (200, details) if details is not None else (404, {'message': 'Record Not Found'})
+
+        self.count(method, path)
+        return 404, {'message': 'Record Not Found'}
+
+    def strava_calls(self):
+        """Returns the number of requests to the Strava API."""
+        return sum(count for endpoint, count in self.calls.items() if '/api/v3/' in endpoint)
+
+
+class ChunkReader(io.RawIOBase):
+    """A raw response body that reads from a generator of chunks."""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = chunks
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b''
+                return 0
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+class MockHttpClient(HttpClient):
+    """The add-on's pooled HTTP client, with every request answered by the mock."""
+
+    mock = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session.mount('https://', self.mock)
+        self.session.mount('http://', self.mock)
+
+
+class HttpsServer(ThreadingHTTPServer):
+    """Serves the Strava API of the mock over HTTPS on localhost, gzip compressed when the client accepts it.
+
+    Unlike the in-process adapter this goes through real sockets and TLS, so connection reuse and compression show up.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, mock, cert_file, key_file):
+        super().__init__(('127.0.0.1', 0), HttpsHandler)
+        self.mock = mock
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+
+class HttpsHandler(BaseHTTPRequestHandler):
+    """Answers a request to the HTTPS stand-in with the mock, keeping the connection open for the next one."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        status, data = self.server.mock.strava('GET', urlparse(self.path), None, self.headers)
+        body = b''.join(data) if isinstance(data, types.GeneratorType) else json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class CountingProxy:
+    """Forwards TCP connections to a server and counts them and the bytes in both directions, TLS handshakes included."""
+
+    def __init__(self, target):
+        self.target = target
+        self.connections = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            with self.lock:
+                self.connections += 1
+            threading.Thread(target=self.pump, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=self.pump, args=(upstream, client), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+    def pump(self, source, destination):
+        """Copies bytes from source to destination until either side closes."""
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                with self.lock:
+                    self.bytes += len(data)
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for side in (source, destination):
+                try:
+                    side.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class EventWriter:
+    """Counts the events written by an input, keeping the last ones for inspection."""
+
+    def __init__(self, keep=100):
+        self.count = 0
+        self.sourcetypes = collections.Counter()
+        self.events = collections.deque(maxlen=keep)
+        self.lock = threading.Lock()
+
+    def write_event(self, event):
+        with self.lock:
+            self.count += 1
+            self.sourcetypes[event.get('sourcetype')] += 1
+            self.events.append(event)
+
+
+class StoragePassword:  # pylint: disable=too-few-public-methods
+    """A secret in storage/passwords of splunklib, its content has the clear password."""
+
+    def __init__(self, username, password):
+        self.name = f':{username}:'
+        self.username = username
+        self.clear_password = password
+        self.content = self
+
+    def update(self, password):
+        self.clear_password = password
+
+
+class StoragePasswords(dict):
+    """The storage/passwords collection of splunklib, by username."""
+
+    def __getitem__(self, name):
+        username = name.strip(':')
+        if username not in self:
+            raise KeyError(name)
+        return dict.__getitem__(self, username)
+
+    def create(self, password, username):
+        self[username] = StoragePassword(username, password)
+        return self[username]
+
+    def delete(self, username):
+        self.pop(username, None)
+
+
+class Service:
+    """A splunklib service with only the storage/passwords collection, shared by every connection."""
+
+    storage_passwords = StoragePasswords()
+
+
+def connect(**kwargs):  # pylint: disable=unused-argument
+    """Replaces splunklib's client.connect()."""
+    return Service()
+
+
+class Helper:  # pylint: disable=too-many-public-methods
+    """The modular input helper of a single input stanza, with checkpoints kept in memory.
+
+    Arguments are returned per stanza like the helper does in single instance mode when per_stanza is set, which the
+    webhook expects.
+    """
+
+    use_single_instance = False
+
+    def __init__(self, stanza, input_type, args=None, settings=None, checkpoints=None, checkpoint_dir=None, per_stanza=False):  # pylint: disable=too-many-arguments
+        self.stanza = stanza
+        self.input_type = input_type
+        self.args = args or {}
+        self.settings = settings or {}
+        self.checkpoints = checkpoints if checkpoints is not None else {}
+        self.per_stanza = per_stanza
+        self.context_meta = {'session_key': 'mock-session-key', 'server_uri': 'https://127.0.0.1:8089', 'checkpoint_dir': checkpoint_dir}
+        self.logs = collections.Counter()
+        # Checkpoints written, each one is a request to the KV Store
+        self.checkpoint_writes = 0
+
+    def delete_check_point(self, key):
+        self.checkpoints.pop(key, None)
+
+    def get_arg(self, arg_name):
+        value = self.args.get(arg_name)
+        return {self.stanza: value} if self.per_stanza and value is not None else value
+
+    def get_check_point(self, key):
+        # Round trip through JSON like the KV Store, so the input can't hold on to the stored object
+        return json.loads(json.dumps(self.checkpoints[key])) if key in self.checkpoints else None
+
+    def get_global_setting(self, name):
+        return self.settings.get(name)
+
+    def get_input_stanza(self, input_stanza_name=None):  # pylint: disable=unused-argument
+        return {self.stanza: dict(self.args)}
+
+    def get_input_type(self):
+        return self.input_type
+
+    def get_output_index(self, input_stanza_name=None):  # pylint: disable=unused-argument
+        return 'strava'
+
+    def get_sourcetype(self, input_stanza_name=None):  # pylint: disable=unused-argument
+        return 'strava:webhook' if self.input_type == 'strava_webhook' else 'strava:activities'
+
+    def log(self, level, message):  # pylint: disable=unused-argument
+        self.logs[level] += 1
+
+    def log_debug(self, message):
+        self.log('debug', message)
+
+    def log_error(self, message):
+        self.log('error', message)
+
+    def log_info(self, message):
+        self.log('info', message)
+
+    def log_warning(self, message):
+        self.log('warning', message)
+
+    @staticmethod
+    def new_event(data, source=None, index=None, sourcetype=None, time=None, **kwargs):  # pylint: disable=redefined-outer-name,too-many-arguments
+        return dict(kwargs, data=data, source=source, index=index, sourcetype=sourcetype, time=time)
+
+    def save_check_point(self, key, state):
+        self.checkpoint_writes += 1
+        self.checkpoints[key] = json.loads(json.dumps(state))
+
+
+def epoch(timestamp):
+    """Converts a Strava timestamp to an epoch timestamp."""
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def matches(document, query):
+    """Returns True if a KV Store document matches a query of field values, $lte and $or."""
+    if '$or' in query:
+        return any(matches(document, alternative) for alternative in query['$or'])
+    return all(document.get(field) is not None and document[field] <= value['$lte'] if isinstance(value, dict) else str(document.get(field)) == str(value)
+               for field, value in query.items())
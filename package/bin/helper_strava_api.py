@@ -1,14 +1,26 @@
 import import_declare_test
+import configparser
+import os
 import sys
 
 from splunklib import modularinput as smi
 from splunktaucclib.modinput_wrapper import base_modinput as ucc
 
 
+def single_instance_enabled():
+    """Reads the single instance setting from the app's settings file, as the scheme is requested before any configuration is passed in."""
+    settings = configparser.ConfigParser(interpolation=None)
+    try:
+        settings.read(os.path.join(os.environ.get('SPLUNK_HOME', ''), 'etc', 'apps', 'TA-strava-for-splunk', 'local', 'ta_strava_for_splunk_settings.conf'))
+        return settings.getboolean('additional_parameters', 'single_instance', fallback=False)
+    except (configparser.Error, ValueError):
+        return False
+
+
 class STRAVA_API(ucc.BaseModInput):
 
     def __init__(self):
-        use_single_instance = False
+        use_single_instance = single_instance_enabled()
         super(STRAVA_API, self).__init__("ta_strava_for_splunk", "strava_api", use_single_instance)
 
     def get_scheme(self):
@@ -17,7 +29,7 @@ class STRAVA_API(ucc.BaseModInput):
         scheme.description = 'Retrieves Strava activity data using the Strava API.'
         scheme.use_external_validation = True
         scheme.streaming_mode_xml = True
-        scheme.use_single_instance = False
+        scheme.use_single_instance = self.use_single_instance
 
         scheme.add_argument(
             smi.Argument(
@@ -42,6 +54,104 @@ class STRAVA_API(ucc.BaseModInput):
             )
         )
 
+        scheme.add_argument(
+            smi.Argument(
+                'stream_format',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'stream_pack_size',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'metrics_index',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'stream_types',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'stream_resolution',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'stream_series_type',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'downsample_interval',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'latlng_tolerance',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'per_page',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'summary_only',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'detail_types',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'fetch_workers',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'backfill_window',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'profile_refresh_interval',
+                required_on_create=False,
+            )
+        )
+
         scheme.add_argument(
             smi.Argument(
                 'reindex_data',
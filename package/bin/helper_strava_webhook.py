@@ -62,6 +62,20 @@ class STRAVA_WEBHOOK(ucc.BaseModInput):
             )
         )
 
+        scheme.add_argument(
+            smi.Argument(
+                'reload_delay',
+                required_on_create=False,
+            )
+        )
+
+        scheme.add_argument(
+            smi.Argument(
+                'direct_fetch',
+                required_on_create=False,
+            )
+        )
+
         return scheme
 
     def get_app_name(self):
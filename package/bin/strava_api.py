@@ -1,31 +1,228 @@
 import sys
 import json
 import time
+import collections
 import datetime
 import calendar
+import os
+import random
+import signal
+import concurrent.futures
+import threading
 import requests
 
 import helper_strava_api as hsa
 from splunklib import client
+from strava_checkpoint import CheckpointManager
+from strava_cache import ResponseCache
+from strava_http import HttpClient, StravaApiError
+from strava_kvstore import ActivityDigests, Segments, WebhookUpdates, content_hash
+from strava_metrics import METRICS_SOURCETYPE, RunMetrics, profiled
+from strava_rate_limit import RateLimitExceeded, RateLimitGovernor, parse_rate_limit
+from strava_scheduler import AthleteScheduler
+from strava_streams import CHUNK_SIZE, build_events, compact, downsample, get_stream_columns, get_stream_types, parse_streams, streams_aligned
+
+# Retries for server errors and timeouts, with exponential backoff between BACKOFF_BASE and BACKOFF_CAP seconds
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 2
+BACKOFF_CAP = 60
+# Longest wait for the shared rate limit before stopping the run and resuming in a later one
+MAX_RATE_LIMIT_WAIT = 60
+# Checkpoints are written to the KV Store every CHECKPOINT_FLUSH_EVERY activities or CHECKPOINT_FLUSH_INTERVAL seconds
+CHECKPOINT_FLUSH_EVERY = 20
+CHECKPOINT_FLUSH_INTERVAL = 30
+# Upper limit for the fetch_workers argument
+MAX_FETCH_WORKERS = 8
+# Upper limit for the per_page argument, the most Strava returns
+MAX_PER_PAGE = 200
+# Activities fetched ahead per fetch worker while earlier ones are written, so their streams don't pile up in memory
+FETCH_AHEAD = 2
 
 
 class StravaApi(hsa.STRAVA_API):
     """Inherits helper_strava_api class and overwrites collect_events() function."""
 
-    def collect_events(helper, ew):  # pylint: disable=broad-exception-raised,no-self-argument,invalid-name,too-many-statements,too-many-branches
-        """Main function to get data into Splunk."""
+    def collect_events(helper, ew):  # pylint: disable=no-self-argument,invalid-name
+        """Main function to get data into Splunk. In single instance mode, one process runs all athletes on a schedule."""
+        if helper.use_single_instance:
+            profiled('strava_api', AthleteScheduler(helper, ew, StravaApi.collect_athlete).run)
+        else:
+            profiled('strava_api', StravaApi.collect_athlete, helper, ew)
+
+    def collect_athlete(helper, ew, http_client=None, max_activities=None):  # pylint: disable=broad-exception-raised,no-self-argument,invalid-name,too-many-statements,too-many-branches
+        """Gets the activities of a single athlete. Returns True if it stopped after max_activities with more activities to get."""
+
+        def backoff(attempt, reason):
+            """Sleeps before the next attempt, exponentially longer for each attempt and with full jitter."""
+            # Jitter only spreads out retries, it doesn't need to be unpredictable
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))  # nosec B311
+            helper.log_warning(f'{reason}. Retrying in {delay:.1f} seconds (attempt {attempt}/{MAX_ATTEMPTS}).')
+            with metrics.time('backoff'):
+                time.sleep(delay)
+
+        def backfill(ts_activity):
+            """Gets the history after ts_activity in time windows that are fetched in parallel, each with its own checkpoint.
+
+            Returns the start time of the last activity once all windows are done, or None if it stopped after
+            max_activities. An interrupted backfill continues with the windows that aren't done in the next run.
+            """
+            state = checkpoints.get(backfill_key)
+            if state:
+                helper.log_info(f'Resuming backfill for {athlete_name} ({athlete_id}), {sum(window["done"] for window in state["windows"])}/{len(state["windows"])} windows done.')
+            else:
+                # Start the windows at the first activity instead of at the start time, which can be decades earlier
+                first_activities = get_activities(ts_activity, access_token)
+                if not first_activities:
+                    return ts_activity
+                first = get_epoch(first_activities[0]['start_date']) - 1
+                until = int(time.time())
+                state = {
+                    'until': until,
+                    'windows': [{'start': start, 'end': min(start + backfill_window, until), 'cursor': start, 'done': False} for start in range(first, until, backfill_window)]}
+                checkpoints.save(backfill_key, state, force=True)
+                helper.log_info(f'Starting backfill for {athlete_name} ({athlete_id}) in {len(state["windows"])} windows of {backfill_window // 86400} days.')
+
+            windows = state['windows']
+            pending = [window for window in windows if not window['done']]
+            running = {}
+            activity_count = 0
+            started = time.time()
+            while pending or running:
+                # Keep a page per fetch worker in flight, until max_activities have been fetched in this turn
+                while pending and len(running) < fetch_workers and not (max_activities and activity_count >= max_activities):
+                    window = pending.pop(0)
+                    running[submit(backfill_page, window)] = window
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    window = running.pop(future)
+                    cursor, count, finished = future.result()
+                    activity_count += count
+                    window.update({'cursor': cursor, 'done': finished})
+                    if not finished:
+                        # Continue with the next page of the same window
+                        pending.insert(0, window)
+                    else:
+                        rate = activity_count / max(time.time() - started, 1) * 60
+                        helper.log_info(f'Backfill for {athlete_name} ({athlete_id}): {sum(window["done"] for window in windows)}/{len(windows)} windows done, {activity_count} activities at {rate:.0f} activities per minute.')
+                    checkpoints.save(backfill_key, state)
+
+            if not all(window['done'] for window in windows):
+                return None
+            checkpoints.save(backfill_key, {}, force=True)
+            helper.log_info(f'Backfill for {athlete_name} ({athlete_id}) done in {time.time() - started:.0f} seconds.')
+            return max((window['cursor'] for window in windows if window['cursor'] > window['start']), default=ts_activity)
+
+        def backfill_page(window):
+            """Gets and writes the next page of activities of a backfill window, runs in a worker thread.
+
+            Returns the start time of the last activity on the page, the number of activities and whether the window is done.
+            """
+            response_activities = get_activities(window['cursor'], access_token, before=window['end'] + 1)
+            if not response_activities:
+                return window['cursor'], 0, True
+
+            known_digests = activity_digests.get([event['id'] for event in response_activities])
+            digests = []
+            cursor = window['cursor']
+            try:
+                for event in response_activities:
+                    activity_id = event['id']
+                    response, stream_data = fetch_activity(activity_id, known_digests.get(activity_id, {}), event)
+                    cursor = get_epoch(event['start_date'])
+                    if response:
+                        digests.append(write_activity(activity_id, response, stream_data, cursor, known_digests.get(activity_id, {})))
+            finally:
+                # Also when the page is interrupted, so the activities written so far are skipped when the window is resumed
+                activity_digests.batch_save(digests)
+                segments.save()
+            # A page that isn't full is the last one of the window
+            return cursor, len(response_activities), len(response_activities) < per_page
+
+        def cached(key, fetch, *args):
+            """Returns the cached response for key, otherwise fetches it and caches it. Fetches without the cache if key is None."""
+            if response_cache is None or key is None:
+                return fetch(*args)
+            response = response_cache.get(key)
+            if response is None:
+                response = fetch(*args)
+                if response:
+                    try:
+                        response_cache.put(key, response)
+                    except OSError as ex:
+                        helper.log_warning(f'Could not cache response {key}: {ex}')
+            return response
 
         def clear_checkbox(session_key, stanza):
             """ Sets the 'reindex_data' value in the REST API to 0 to clear it. Splunk then automatically restarts the input."""
             url = f'https://localhost:8089/servicesNS/nobody/TA-strava-for-splunk/data/inputs/strava_api/{stanza}'
             headers = {'Authorization': f'Splunk {session_key}'}
             payload = 'reindex_data=0'
-            helper.send_http_request(url, "POST", headers=headers, payload=payload, verify=False, use_proxy=False)
-
-        def get_activities(ts_activity, token):
-            """Gets all activities, 30 per page as per Strava's default."""
+            http_client.send_http_request(url, "POST", headers=headers, payload=payload, verify=False)
+
+        def counted(chunks):
+            """Passes on the chunks of a response body, counting the bytes received."""
+            for chunk in chunks:
+                metrics.add('bytes_received', len(chunk))
+                yield chunk
+
+        def fetch_activity(activity_id, digest, summary=None):
+            """Gets an activity and its stream, runs in a worker thread. Returns (activity, stream), either can be False.
+
+            The summary from the list of activities is used instead of the details if those aren't needed. The stream is
+            only requested if the activity is new or its distance, duration or device changed, otherwise it's None.
+            With the response cache on, the details are cached by the summary and the stream by the fields it depends on.
+            """
+            if summary and not needs_details(summary):
+                response = summary
+            else:
+                # Activities updated via the webhook have no summary to tell if the cached details are still current. Edits
+                # like the description don't change the summary either, so drop what's cached for the activity.
+                if summary is None and response_cache:
+                    response_cache.remove(f'{activity_id}-')
+                response = cached(summary and f'{activity_id}-{content_hash(summary)}', get_activity, activity_id, access_token)
+            if not response:
+                return response, False
+            stream_key = ActivityDigests.stream_key(response)
+            if digest.get('stream_key') == stream_key:
+                return response, None
+            stream_version = content_hash([stream_key, types, stream_series_type, stream_resolution])
+            stream_data = cached(f'{activity_id}-{stream_version}-stream', get_activity_stream, access_token, activity_id, types, stream_series_type, stream_resolution)
+            if stream_data:
+                # Streams read from the cache are lists, keep their values as compact arrays like streams from Strava
+                for stream in stream_data:
+                    if isinstance(stream.get('data'), list):
+                        stream['data'] = compact(stream['data'])
+            return response, stream_data
+
+        def fetch_in_order(activity_ids, digests, summaries=None):
+            """Fetches activities concurrently and yields (activity, stream) in the order of activity_ids.
+
+            Only FETCH_AHEAD activities per worker are fetched ahead of the one being written, so a page of long
+            activities doesn't keep all their streams in memory at once.
+            """
+            summaries = summaries or [None] * len(activity_ids)
+            pending = collections.deque()
+            try:
+                for activity_id, summary in zip(activity_ids, summaries):
+                    pending.append(submit(fetch_activity, activity_id, digests.get(activity_id, {}), summary))
+                    if len(pending) >= fetch_workers * FETCH_AHEAD:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # Don't fetch the rest when writing stopped, e.g. when the rate limit was hit
+                for future in pending:
+                    future.cancel()
+
+        def get_activities(ts_activity, token, before=None):
+            """Gets a page of activities after ts_activity, oldest first."""
             headers = {'Authorization': f'Bearer {token}'}
-            params = {'after': ts_activity}
+            params = {'after': ts_activity, 'per_page': per_page}
+            if before:
+                params['before'] = before
             url = "https://www.strava.com/api/v3/activities"
             response = return_json(url, "GET", headers=headers, parameters=params)
             return response
@@ -40,9 +237,11 @@ class StravaApi(hsa.STRAVA_API):
         def get_activity_stream(token, activity, types, series_type='time', resolution='high'):
             """Gets the activity stream for given activity id."""
             types = ','.join(types)
-            url = f'https://www.strava.com/api/v3/activities/{activity}/streams/{types}&series_type={series_type}&resolution={resolution}&key_by_type='
+            url = f'https://www.strava.com/api/v3/activities/{activity}/streams/{types}'
             headers = {'Authorization': f'Bearer {token}'}
-            response = return_json(url, "GET", headers=headers, timeout=10)
+            params = {'series_type': series_type, 'resolution': resolution, 'key_by_type': 'true'}
+            # Streams of long activities are large, parse them while they come in and keep the values as compact arrays
+            response = return_json(url, "GET", parse=parse_streams, headers=headers, parameters=params, timeout=10)
             return response
 
         def get_athlete(token):
@@ -59,13 +258,18 @@ class StravaApi(hsa.STRAVA_API):
             return epoch
 
         def get_secret(session_key, key):
-            # Retrieve the password from the storage/passwords endpoint
-            service = client.connect(token=session_key, app='TA-strava-for-splunk')
-            for storage_password in service.storage_passwords:
-                if storage_password.username == key:
-                    return json.loads(storage_password.content.clear_password)
-            return None
+            """Retrieves the password for 'key' by name from the storage/passwords endpoint."""
+            try:
+                storage_password = get_service(session_key).storage_passwords[f':{key}:']
+            except KeyError:
+                return None
+            return json.loads(storage_password.content.clear_password)
 
+        def get_service(session_key):
+            """Returns a connection to splunkd, shared by all secret lookups in this run."""
+            if session_key not in services:
+                services[session_key] = client.connect(token=session_key, app='TA-strava-for-splunk')
+            return services[session_key]
 
         def get_token(client_id, client_secret, token, renewal):
             """Get or refresh access token from Strava API."""
@@ -95,82 +299,104 @@ class StravaApi(hsa.STRAVA_API):
             url = 'https://localhost:8089/servicesNS/nobody/TA-strava-for-splunk/storage/collections/data/strava_athlete/batch_save'
             headers = {'Content-Type': 'application/json', 'Authorization': f'Splunk {session_key}'}
             payload = [{"_key": athlete_id, "id": athlete_id, "firstname": firstname, "lastname": lastname, "fullname": firstname + " " + lastname, "weight": weight, "ftp": ftp}]
-            helper.send_http_request(url, "POST", headers=headers, payload=payload, verify=False, use_proxy=False)
+            http_client.send_http_request(url, "POST", headers=headers, payload=payload, verify=False)
+
+        def needs_details(summary):
+            """Returns True if the details of an activity have to be fetched, instead of writing its summary from the list of activities."""
+            return not summary_only or summary.get('sport_type') in detail_types or summary.get('type') in detail_types
 
         def parse_data(data, activity_id, activity_start_date):
             """Gets raw JSON data, parses it into events and writes those to Splunk."""
-            data_dict = {}
-            final_dict = {}
-            for i in data:
-                data_dict[i['type']] = i['data']
-
-            counter = 1
-            nrange = len(data_dict['time'])
-            for item in range(1, nrange + 1):
-                final_dict[item] = {}
-
-            for key, value in data_dict.items():
-                counter = 1
-                for i in value:
-                    final_dict[counter][key] = i
-                    final_dict[counter]['activity_id'] = activity_id
+            with metrics.time('parse'):
+                epochs, columns = get_stream_columns(data, activity_start_date)
+                if not epochs:
+                    helper.log_warning(f'No time stream found for activity {activity_id}, skipping activity stream.')
+                    return False
 
-                    if 'time' in key:
-                        final_dict[counter]['time'] = final_dict[counter]['time'] + activity_start_date
-                        final_dict[counter]['time'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(final_dict[counter]['time']))
+                if not streams_aligned(epochs, columns):
+                    helper.log_debug(f'Stream lengths differ for activity {activity_id}: {dict((key, len(column)) for key, column in columns.items())}, time: {len(epochs)}.')
 
-                    if 'latlng' in key:
-                        final_dict[counter]['lat'] = final_dict[counter]['latlng'][0]
-                        final_dict[counter]['lon'] = final_dict[counter]['latlng'][1]
-                        final_dict[counter].pop('latlng')
-                    counter += 1
+                if downsample_interval or latlng_tolerance:
+                    points = len(epochs)
+                    epochs, columns = downsample(epochs, columns, downsample_interval, latlng_tolerance)
+                    helper.log_info(f'Downsampled stream of activity {activity_id} from {points} to {len(epochs)} points, reduction ratio {points / len(epochs):.1f}.')
 
-            result_list = [value for key, value in final_dict.items()]
+            index = helper.get_output_index()
+            sourcetype, events = build_events(epochs, columns, activity_id, athlete_id, stream_format, stream_pack_size)
+            if stream_format == 'metrics':
+                index = metrics_index
 
-            for event in result_list:
-                write_to_splunk(index=helper.get_output_index(), sourcetype='strava:activities:stream', data=json.dumps(event))
+            # Events are built while they're written, so this includes turning the columns into events
+            with metrics.time('write'):
+                for event in events:
+                    write_to_splunk(index=index, sourcetype=sourcetype, data=json.dumps(event))
+            metrics.add('stream_points', len(epochs))
+            metrics.add('streams_written')
 
             helper.log_info(f'Added activity stream {activity_id} for {athlete_id}.')
             return True
 
-        def return_json(url, method, **kwargs):
-            """Gets JSON from URL and parses it for potential error messages."""
-            response = helper.send_http_request(url, method, use_proxy=False, **kwargs)
+        def return_json(url, method, parse=None, **kwargs):
+            """Gets JSON from URL and parses it for potential error messages. Server errors and timeouts are retried with backoff.
+
+            With parse, the body is downloaded in chunks that are passed to parse as they come in, instead of read as a whole.
+            """
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                with metrics.time('rate_limit_wait'):
+                    governor.acquire(max_wait=MAX_RATE_LIMIT_WAIT)
+                try:
+                    with metrics.time('api'):
+                        response = http_client.send_http_request(url, method, stream=parse is not None, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as ex:
+                    metrics.add('api_connection_errors')
+                    if attempt == MAX_ATTEMPTS:
+                        raise StravaApiError(f'No response from Strava API for url {url} after {attempt} attempts: {ex}') from ex
+                    backoff(attempt, ex)
+                    continue
+
+                metrics.record_response(method, url, response, streamed=parse is not None)
+                governor.update(response.headers)
+                if response.status_code < 500 or attempt == MAX_ATTEMPTS:
+                    break
+                response.close()
+                backoff(attempt, f'{response.status_code} Error for url {url}')
 
             try:
                 response.raise_for_status()
             except requests.HTTPError as ex:
-                # status code 429 means we hit Strava's API limit, wait till next 15 minute mark (+5 seconds) and try again
+                response.close()
+                # status code 429 means we hit Strava's API limit, stop here and let the next run continue once the limit has been reset
                 if ex.response.status_code == 429:
-                    # Get the 15m/24h API limits for this user
-                    api_usage_15m = response.headers['X-RateLimit-Usage'].split(",")[0]
-                    api_usage_24h = response.headers['X-RateLimit-Usage'].split(",")[1]
-                    api_limit_15m = response.headers['X-RateLimit-Limit'].split(",")[0]
-                    api_limit_24h = response.headers['X-RateLimit-Limit'].split(",")[1]
+                    # Get the 15m/24h API limits for this user, the read limit when that's the one used up
+                    rate_limit = parse_rate_limit(response.headers)
 
                     timestamp_now = int(time.time())
-                    modulus_time = timestamp_now % 900
-                    sleepy_time = 0 if modulus_time == 0 else (900 - modulus_time + 5)
-                    helper.log_warning(f'Strava API rate limit hit. Used {api_usage_15m}/15min (limit {api_limit_15m}), {api_usage_24h}/24h (limit {api_limit_24h}). Sleeping for {sleepy_time} seconds.')
-                    time.sleep(sleepy_time)
-                    response = return_json(url, method, **kwargs)
-                    helper.log_debug(f'429 detail: {response}')
-                    return response
+                    if rate_limit is None:
+                        # Without the headers it's unknown which limit was hit, wait for the next 15 minute window
+                        window = 900
+                        helper.log_warning('Strava API rate limit hit, no rate limit details in the response.')
+                    else:
+                        window = 86400 if rate_limit['usage_day'] >= rate_limit['limit_day'] else 900
+                        helper.log_warning(f"Strava API rate limit hit. Used {rate_limit['usage_15m']}/15min (limit {rate_limit['limit_15m']}), {rate_limit['usage_day']}/24h (limit {rate_limit['limit_day']}).")
+                    resume_after = timestamp_now - timestamp_now % window + window + 5
+                    raise RateLimitExceeded(resume_after) from ex
                 if ex.response.status_code in (400, 401):
-                    helper.log_error(f'{ex.response.status_code} Error: Strava API credentials invalid or session expired. Make sure Client ID & Client Secret have been added to the Configuration -> Add-On Parameters tab and your access code is valid.')
-                    sys.exit(1)
+                    # Stop this run like any other error, so its checkpoints are saved and its metrics written
+                    raise StravaApiError(f'{ex.response.status_code} Error: Strava API credentials invalid or session expired. Make sure Client ID & Client Secret have been added to the Configuration -> Add-On Parameters tab and your access code is valid') from ex
                 if ex.response.status_code == 404:
                     helper.log_warning(f'404 Error: no stream data for url {url}, can happen for manually added activities.')
                     return False
                 if ex.response.status_code == 500:
                     helper.log_warning(f'500 Error: no data received from Strava API for url {url}, it might be corrupt or invalid. Skipping activity.')
                     return False
-                # In case there's any other error than the ones described above, log the error and exit.
-                helper.log_error(f'Error: {ex}')
-                sys.exit(1)
+                # In case there's any other error than the ones described above, stop this run. Progress so far is in the checkpoint.
+                raise StravaApiError(f'Error: {ex}') from ex
 
             # Must have been a 200 status code
-            return response.json()
+            if parse is None:
+                return response.json()
+            with response, metrics.time('download'):
+                return parse(counted(response.iter_content(chunk_size=CHUNK_SIZE)))
 
         def set_athlete(response):
             """Creates dict with athlete details, including token expiry."""
@@ -188,15 +414,19 @@ class StravaApi(hsa.STRAVA_API):
                 "refresh_token": response['refresh_token'],
                 "expires_at": response['expires_at']}
 
-        def store_secret(session_key, key, secret):
-            """Stores OAuth details as Splunk encrypted password in 'key' as dict."""
-            service = client.connect(token=session_key, app='TA-strava-for-splunk')
+        def stop(signum, frame):  # pylint: disable=unused-argument
+            """Saves pending checkpoints when Splunk stops the input."""
+            helper.log_info('Input is being stopped, saving checkpoints.')
+            checkpoints.flush()
+            sys.exit(0)
+
+        def store_secret(session_key, key, secret, replace):
+            """Stores OAuth details as Splunk encrypted password in 'key' as dict, replacing the existing one if replace is set."""
+            service = get_service(session_key)
 
             try:
-                for storage_password in service.storage_passwords:
-                    if storage_password.username == key:
-                        service.storage_passwords.delete(username=storage_password.username)
-                        break
+                if replace:
+                    service.storage_passwords.delete(username=key)
 
                 storage_secret = service.storage_passwords.create(json.dumps(secret), key)
                 return storage_secret
@@ -204,22 +434,114 @@ class StravaApi(hsa.STRAVA_API):
             except Exception as err:
                 raise Exception(f'An error occurred updating credentials. Please ensure your user account has admin_all_objects and/or list_storage_passwords capabilities. Details: {err}') from err
 
+        def submit(function, *args):
+            """Runs function in a fetch worker and returns its future, which is cancelled if the run stops before it started."""
+            future = executor.submit(function, *args)
+            submitted.add(future)
+            future.add_done_callback(submitted.discard)
+            return future
+
+        def write_activity(activity_id, response, stream_data, activity_start_date, digest):
+            """Writes the activity and its stream, leaving out what hasn't changed since it was last written. Returns the new digest of the activity."""
+            activity_hash = content_hash(response)
+            if activity_hash != digest.get('activity_hash'):
+                with metrics.time('write'):
+                    write_to_splunk(index=helper.get_output_index(), sourcetype=helper.get_sourcetype(), data=json.dumps(response))
+                metrics.add('activities_written')
+                helper.log_info(f'Added activity {activity_id} for {athlete_id}.')
+            else:
+                metrics.add('activities_unchanged')
+                helper.log_info(f'Activity {activity_id} for {athlete_id} hasn\'t changed, skipping it.')
+
+            # The stream key only changes once the stream has been written, so a stream that failed is requested again next time
+            stream_hash = digest.get('stream_hash')
+            stream_key = digest.get('stream_key')
+            if stream_data:
+                new_stream_hash = content_hash(stream_data)
+                if new_stream_hash == stream_hash:
+                    helper.log_info(f'Activity stream {activity_id} for {athlete_id} hasn\'t changed, skipping it.')
+                    stream_key = ActivityDigests.stream_key(response)
+                elif parse_data(stream_data, activity_id, activity_start_date):
+                    stream_hash = new_stream_hash
+                    stream_key = ActivityDigests.stream_key(response)
+
+            return ActivityDigests.document(activity_id, athlete_id, activity_hash, stream_key, stream_hash, segments.add(response, digest), activity_start_date)
 
         def write_to_splunk(**kwargs):
-            """Writes activity to Splunk index."""
+            """Writes activity to Splunk index. Backfill windows write from several threads."""
             event = helper.new_event(**kwargs)
-            ew.write_event(event)
+            with write_lock:
+                ew.write_event(event)
+            metrics.add('events_written')
 
         # get configuration arguments
         client_id = helper.get_global_setting('client_id')
         client_secret = helper.get_global_setting('client_secret')
         access_code = helper.get_arg('access_code')
-        start_time = helper.get_arg('start_time') or 0
-        types = ['time', 'distance', 'latlng', 'altitude', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'temp', 'moving', 'grade_smooth']
+        start_time = int(helper.get_arg('start_time') or 0)
+        stream_format = helper.get_arg('stream_format') or 'points'
+        stream_pack_size = int(helper.get_arg('stream_pack_size') or 500)
+        metrics_index = helper.get_arg('metrics_index')
+        # Metric data points can't go to the input's index, which is an event index
+        if stream_format == 'metrics' and not metrics_index:
+            helper.log_error('Stream format Metrics requires a Metrics index, writing one event per point instead.')
+            stream_format = 'points'
+        # Strava allows 100 read requests per 15 minutes by default, keep the number of concurrent requests low
+        fetch_workers = min(max(int(helper.get_arg('fetch_workers') or 1), 1), MAX_FETCH_WORKERS)
+        types = get_stream_types(helper.get_arg('stream_types'))
+        stream_resolution = helper.get_arg('stream_resolution') or 'high'
+        stream_series_type = helper.get_arg('stream_series_type') or 'time'
+        # Merging stream points while ingesting, off by default
+        downsample_interval = int(helper.get_arg('downsample_interval') or 0)
+        latlng_tolerance = float(helper.get_arg('latlng_tolerance') or 0)
+        profile_refresh_interval = int(helper.get_arg('profile_refresh_interval') or 86400)
+        # Strava returns at most 200 activities per page
+        per_page = min(max(int(helper.get_arg('per_page') or 30), 1), MAX_PER_PAGE)
+        # Write the summaries from the list of activities, except for these activity types, instead of getting the details of every activity
+        summary_only = int(helper.get_arg('summary_only') or 0) == 1
+        detail_types = {activity_type.strip() for activity_type in (helper.get_arg('detail_types') or '').split(',') if activity_type.strip()}
+        # Length of the time windows of a backfill in seconds, 0 turns backfilling off
+        backfill_window = int(helper.get_arg('backfill_window') or 0) * 86400
+        # Size of the on-disk cache of activity details and streams in MB, 0 turns it off
+        response_cache_size = int(helper.get_global_setting('response_cache_size') or 0)
         expires_at = False
+        # splunkd connections by session key
+        services = {}
+
+        # The Strava API rate limit is shared by all athletes using the same Strava application, so keep track of it in a file all inputs use.
+        governor = RateLimitGovernor(os.path.join(os.path.dirname(helper.context_meta['checkpoint_dir']), 'strava_rate_limit.json'), helper)
+
+        # All requests to Strava and splunkd share a pool of kept-alive connections, with room for every fetch worker.
+        # In single instance mode the scheduler passes one pool that is shared by all athletes.
+        own_http_client = http_client is None
+        if own_http_client:
+            http_client = HttpClient(pool_size=fetch_workers + 2)
+
+        # Responses are cached next to the checkpoints and shared by all inputs, so a reindex doesn't have to get them from Strava again.
+        response_cache = None
+        if response_cache_size:
+            response_cache = ResponseCache(os.path.join(os.path.dirname(helper.context_meta['checkpoint_dir']), 'strava_cache'), response_cache_size * 1024 * 1024)
+
+        # Activity details and streams are fetched by a pool of workers, events are written and checkpoints saved in order.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=fetch_workers)
+        # Futures of the workers that haven't finished yet
+        submitted = set()
+        write_lock = threading.Lock()
 
         # stanza is the name of the input. This is a unique name and will be used as a checkpoint key to save/retrieve details about an athlete
         stanza = list(helper.get_input_stanza())[0]
+
+        # Time spent per phase and counters of this run, written as a strava:ta:metrics event when the run ends
+        metrics = RunMetrics(input=stanza)
+
+        # Checkpoints are written in batches, flushed when the run ends or Splunk stops the input.
+        checkpoints = CheckpointManager(helper, flush_every=CHECKPOINT_FLUSH_EVERY, flush_interval=CHECKPOINT_FLUSH_INTERVAL, metrics=metrics)
+        # In single instance mode the scheduler handles Splunk stopping the input, once for all athletes
+        if own_http_client:
+            signal.signal(signal.SIGTERM, stop)
+
+        # The windows of a backfill that's in progress
+        backfill_key = f'{stanza}_backfill'
         # helper.log_debug(f'Athlete: {athlete}')
 
         # Sometimes KV Store isn't ready yet after a Splunk restart causing a TypeError. Wait 15 seconds when that happens and try again.
@@ -231,133 +553,224 @@ class StravaApi(hsa.STRAVA_API):
             athlete = helper.get_check_point(stanza)
 
         # Get the OAuth details from the Splunk storage/passwords REST API endpoint
-        athlete_oauth = get_secret(helper.context_meta['session_key'], stanza)
+        athlete_oauth = stored_oauth = get_secret(helper.context_meta['session_key'], stanza)
 
         if athlete_oauth:
             access_token = athlete_oauth['access_token']
             refresh_token = athlete_oauth['refresh_token']
             expires_at = athlete_oauth['expires_at']
 
-        # if reindex_data checkbox is set, update the start_time to be the one specified and clear the checkbox.
-        if helper.get_arg('reindex_data'):
-            if int(helper.get_arg('reindex_data')) == 1:
-                athlete.update({'ts_activity': start_time})
-                helper.save_check_point(stanza, athlete)
-                # the clear_checkbox function will restart this input as soon as the change is made, so no further code required.
-                clear_checkbox(helper.context_meta['session_key'], stanza)
-
-        # if athlete is set, get details & tokens - otherwise fetch tokens with get_token()
-        if athlete:
-            athlete_id = athlete['id']
-            athlete_name = athlete['name']
-            # If 'access_token' in athlete, it's from a pre-3.2 install. Get its value and remove it, so it can be stored as a Splunk secret and be backwards-compatible.
-            if 'access_token' in athlete and not athlete_oauth:
-                access_token = athlete['access_token']
-                refresh_token = athlete['refresh_token']
-                expires_at = athlete['expires_at']
-                athlete_oauth = {"access_token": access_token, "refresh_token": refresh_token, "expires_at": expires_at}
-                athlete.pop('access_token')
-                athlete.pop('refresh_token')
-                athlete.pop('expires_at')
-
-        # Check if expires_at token is set and renew token if token expired. Otherwise fetch token with initial access code.
-        if expires_at:
-            if time.time() >= expires_at:
-                response = get_token(client_id, client_secret, refresh_token, renewal=True)
-                athlete_oauth = set_athlete_oauth(response)
-        else:
-            response = get_token(client_id, client_secret, access_code, renewal=False)
-            athlete = set_athlete(response)
-            athlete_id = athlete['id']
-            athlete_name = athlete['name']
-            athlete_oauth = set_athlete_oauth(response)
-
-        # Store athlete data in checkpoint and OAuth data in Splunk storage/passwords endpoint
-        helper.save_check_point(stanza, athlete)
-        store_secret(helper.context_meta['session_key'], stanza, athlete_oauth)
-
-        access_token = athlete_oauth['access_token']
-        athlete_detail = get_athlete(access_token)
-        athlete_firstname = athlete_detail['firstname']
-        athlete_lastname = athlete_detail['lastname']
-        athlete_weight = ''
-        athlete_ftp = ''
-        if athlete_detail['resource_state'] == 3:
-            athlete_weight = athlete_detail['weight']
-            athlete_ftp = athlete_detail['ftp']
-
-        helper.log_debug("Saving athlete's details to KV Store.")
-        kvstore_save_athlete(helper.context_meta['session_key'], str(athlete_id), athlete_firstname, athlete_lastname, str(athlete_weight), str(athlete_ftp))
-
-        # For backwards compatibility with upgrades from pre-2.5.0, which uses athlete['ts_newest_activity']. If there, clean them up.
-        if 'ts_newest_activity' in athlete:
-            helper.log_info(f"Found existing timestamp {athlete['ts_newest_activity']}! Will remove it now.")
-            ts_activity = athlete['ts_newest_activity']
-            athlete.update({'ts_activity': ts_activity})
-            athlete.pop('ts_newest_activity')
-            athlete.pop('get_old_activities')
-            athlete.pop('ts_oldest_activity')
-            helper.save_check_point(stanza, athlete)
-        else:
-            ts_activity = athlete['ts_activity'] or start_time
-
-        # webhook_updates contains updated activities that came in via webhook.
-        webhook_updates = helper.get_check_point('webhook_updates') or {}
-
-        if str(athlete_id) in webhook_updates:
-            for activity in webhook_updates[str(athlete_id)][:]:
-                helper.log_info(f'Received update via webhook for activity {activity} from athlete {athlete_id}')
-                response = get_activity(activity, access_token)
-                ts_activity = get_epoch(response['start_date'])
+        # Hashes of what was last written for each activity, looked up per page of activities
+        activity_digests = ActivityDigests(http_client, helper.context_meta['session_key'], metrics)
+        # Segments of the written activities, added to the strava_segments lookup along with the digests
+        segments = Segments(http_client, helper.context_meta['session_key'], metrics)
 
-                # Store the event in Splunk
-                write_to_splunk(index=helper.get_output_index(), sourcetype=helper.get_sourcetype(), data=json.dumps(response))
-
-                # Get stream data for this activity and write to Splunk
-                stream_data = get_activity_stream(access_token, activity, types)
-                if stream_data:
-                    parse_data(stream_data, activity, ts_activity)
-
-                # Remove from dict and save dict
-                webhook_updates[str(athlete_id)].remove(activity)
-                helper.save_check_point('webhook_updates', webhook_updates)
-            helper.log_info(f'Got all webhook events for athlete {athlete_id}')
-
-        helper.log_info(f'Checking if there are new activities for {athlete_name} ({athlete_id})')
+        more_activities = False
+        try:
+            # The Strava API rate limit was hit in an earlier run, don't make any requests until it has been reset.
+            resume_after = athlete.pop('resume_after', 0) if athlete else 0
+            if resume_after > time.time():
+                helper.log_info(f'Strava API rate limit hit earlier, resuming after {time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(resume_after))}.')
+                return False
+
+            # if reindex_data checkbox is set, update the start_time to be the one specified and clear the checkbox.
+            if helper.get_arg('reindex_data'):
+                if int(helper.get_arg('reindex_data')) == 1:
+                    athlete.update({'ts_activity': start_time})
+                    checkpoints.save(stanza, athlete, force=True)
+                    # Write all activities again, not only the ones that changed, and start a new backfill
+                    if athlete:
+                        # Their segment efforts are counted again when the activities are written
+                        segments.remove(activity_digests.remove_athlete(athlete['id'], start_time))
+                        segments.save()
+                    checkpoints.save(backfill_key, {}, force=True)
+                    # the clear_checkbox function will restart this input as soon as the change is made, so no further code required.
+                    clear_checkbox(helper.context_meta['session_key'], stanza)
+
+            # if athlete is set, get details & tokens - otherwise fetch tokens with get_token()
+            if athlete:
+                athlete_id = athlete['id']
+                athlete_name = athlete['name']
+                # If 'access_token' in athlete, it's from a pre-3.2 install. Get its value and remove it, so it can be stored as a Splunk secret and be backwards-compatible.
+                if 'access_token' in athlete and not athlete_oauth:
+                    access_token = athlete['access_token']
+                    refresh_token = athlete['refresh_token']
+                    expires_at = athlete['expires_at']
+                    athlete_oauth = {"access_token": access_token, "refresh_token": refresh_token, "expires_at": expires_at}
+                    athlete.pop('access_token')
+                    athlete.pop('refresh_token')
+                    athlete.pop('expires_at')
+
+            # Check if expires_at token is set and renew token if token expired. Otherwise fetch token with initial access code.
+            if expires_at:
+                if time.time() >= expires_at:
+                    response = get_token(client_id, client_secret, refresh_token, renewal=True)
+                    athlete_oauth = set_athlete_oauth(response)
+            else:
+                response = get_token(client_id, client_secret, access_code, renewal=False)
+                athlete = set_athlete(response)
+                athlete_id = athlete['id']
+                athlete_name = athlete['name']
+                athlete_oauth = set_athlete_oauth(response)
 
-        while True:
+            # Store athlete data in checkpoint and OAuth data in Splunk storage/passwords endpoint
+            checkpoints.save(stanza, athlete, force=True)
+            metrics.dimensions['athlete_id'] = athlete_id
+            # The secret only changes when the token has been refreshed
+            if athlete_oauth != stored_oauth:
+                store_secret(helper.context_meta['session_key'], stanza, athlete_oauth, replace=stored_oauth is not None)
 
-            response_activities = get_activities(ts_activity, access_token)
+            access_token = athlete_oauth['access_token']
 
-            # if all activities retrieved, set get_old_activities, save checkpoint and end loop to finish
-            if len(response_activities) == 0:  # pylint: disable=no-else-break
-                helper.log_info(f'All done, got all activities for {athlete_name} ({athlete_id})')
-                break
+            # Refresh the athlete's details every profile_refresh_interval seconds, and only update the KV Store if they changed.
+            if time.time() - athlete.get('profile_checked', 0) >= profile_refresh_interval:
+                athlete_detail = get_athlete(access_token)
+                athlete_firstname = athlete_detail['firstname']
+                athlete_lastname = athlete_detail['lastname']
+                athlete_weight = ''
+                athlete_ftp = ''
+                if athlete_detail['resource_state'] == 3:
+                    athlete_weight = athlete_detail['weight']
+                    athlete_ftp = athlete_detail['ftp']
+
+                profile = [athlete_firstname, athlete_lastname, str(athlete_weight), str(athlete_ftp)]
+                if profile != athlete.get('profile'):
+                    helper.log_debug("Saving athlete's details to KV Store.")
+                    kvstore_save_athlete(helper.context_meta['session_key'], str(athlete_id), athlete_firstname, athlete_lastname, str(athlete_weight), str(athlete_ftp))
+                    athlete.update({'profile': profile})
+                athlete.update({'profile_checked': int(time.time())})
+                checkpoints.save(stanza, athlete)
+
+            # For backwards compatibility with upgrades from pre-2.5.0, which uses athlete['ts_newest_activity']. If there, clean them up.
+            if 'ts_newest_activity' in athlete:
+                helper.log_info(f"Found existing timestamp {athlete['ts_newest_activity']}! Will remove it now.")
+                ts_activity = athlete['ts_newest_activity']
+                athlete.update({'ts_activity': ts_activity})
+                athlete.pop('ts_newest_activity')
+                athlete.pop('get_old_activities')
+                athlete.pop('ts_oldest_activity')
+                checkpoints.save(stanza, athlete, force=True)
             else:
-                # Get more details from each activity
-                for event in response_activities:
-                    activity_id = event['id']
-                    response = get_activity(activity_id, access_token)
-
-                    # response = False for a 500 Error, which is likely an invalid Strava API file. In that case skip the activity and continue.
+                ts_activity = athlete['ts_activity'] or start_time
+
+            # The strava_webhook_updates collection contains updated activities that came in via webhook.
+            webhook_updates = WebhookUpdates(http_client, helper.context_meta['session_key'], metrics)
+            queued = webhook_updates.get(athlete_id)
+            activities = list(queued)
+
+            # Before 3.3.0 updates were kept in the webhook_updates checkpoint, fetch those too and remove them from it.
+            legacy_updates = helper.get_check_point('webhook_updates') or {}
+            if str(athlete_id) in legacy_updates:
+                activities = list(dict.fromkeys(activities + legacy_updates.pop(str(athlete_id))))
+                checkpoints.save('webhook_updates', legacy_updates, force=True)
+
+            if activities:
+                known_digests = activity_digests.get(activities)
+                fetched = {}
+                digests = []
+                for activity, (response, stream_data) in zip(activities, fetch_in_order(activities, known_digests)):
+                    helper.log_info(f'Received update via webhook for activity {activity} from athlete {athlete_id}')
+                    # Updates are of older activities, so they don't move the checkpoint of the newest activity back
                     if response:
-                        data = json.dumps(response)
-
-                        # Get start_date (UTC) and convert to UTC timestamp
-                        ts_activity = get_epoch(event['start_date'])
-
-                        # Store the event in Splunk
-                        write_to_splunk(index=helper.get_output_index(), sourcetype=helper.get_sourcetype(), data=data)
-                        helper.log_info(f'Added activity {activity_id} for {athlete_id}.')
-
-                        # Get stream data for this activity
-                        stream_data = get_activity_stream(access_token, activity_id, types)
-                        if stream_data:
-                            parse_data(stream_data, activity_id, ts_activity)
-
-                        # Save the timestamp of the last event to a checkpoint
-                        athlete.update({'ts_activity': ts_activity})
-                        helper.save_check_point(stanza, athlete)
+                        digests.append(write_activity(activity, response, stream_data, get_epoch(response['start_date']), known_digests.get(activity, {})))
+
+                    # Remove fetched activities from the collection in batches, updates from the legacy checkpoint aren't in it
+                    if activity in queued:
+                        fetched[activity] = queued[activity]
+                    if len(fetched) >= CHECKPOINT_FLUSH_EVERY:
+                        activity_digests.batch_save(digests)
+                        segments.save()
+                        webhook_updates.remove(athlete_id, fetched)
+                        fetched = {}
+                        digests = []
+                activity_digests.batch_save(digests)
+                segments.save()
+                webhook_updates.remove(athlete_id, fetched)
+                helper.log_info(f'Got all webhook events for athlete {athlete_id}')
+
+            # A long history is fetched in time windows first, after which the loop below continues from the last activity.
+            if backfill_window and (checkpoints.get(backfill_key) or time.time() - ts_activity > backfill_window):
+                ts_backfill = backfill(ts_activity)
+                if ts_backfill is None:
+                    helper.log_info(f'Backfill for {athlete_name} ({athlete_id}) continues in the next turn.')
+                    return True
+                ts_activity = max(ts_activity, ts_backfill)
+                athlete.update({'ts_activity': ts_activity})
+                checkpoints.save(stanza, athlete, force=True)
+
+            helper.log_info(f'Checking if there are new activities for {athlete_name} ({athlete_id})')
+
+            activity_count = 0
+            next_page = submit(get_activities, ts_activity, access_token)
+            while next_page:
+                response_activities = next_page.result()
+                activity_count += len(response_activities)
+
+                # A page that isn't full is the last one. Otherwise the next page is requested in the background while the
+                # activities on this page are fetched, unless other athletes get a turn first in single instance mode.
+                next_page = None
+                if len(response_activities) == per_page:
+                    if max_activities and activity_count >= max_activities:
+                        more_activities = True
+                    else:
+                        next_page = submit(get_activities, get_epoch(response_activities[-1]['start_date']), access_token)
+
+                # Get more details from each activity, fetched concurrently but handled in the order of the page
+                activity_ids = [event['id'] for event in response_activities]
+                known_digests = activity_digests.get(activity_ids)
+                digests = []
+                try:
+                    for event, (response, stream_data) in zip(response_activities, fetch_in_order(activity_ids, known_digests, response_activities)):
+                        activity_id = event['id']
+
+                        # response = False for a 500 Error, which is likely an invalid Strava API file. In that case skip the activity and continue.
+                        if response:
+                            # Get start_date (UTC) and convert to UTC timestamp
+                            ts_activity = get_epoch(event['start_date'])
+
+                            # Store the activity and its stream in Splunk, unless they were written before and haven't changed
+                            digests.append(write_activity(activity_id, response, stream_data, ts_activity, known_digests.get(activity_id, {})))
+
+                            # Save the timestamp of the last event to a checkpoint, all earlier activities on the page have been written by now
+                            athlete.update({'ts_activity': ts_activity})
+                            checkpoints.save(stanza, athlete)
+                finally:
+                    # Also when the run is interrupted, so the activities written so far are skipped when they're fetched again
+                    activity_digests.batch_save(digests)
+                    segments.save()
+
+            # Give other athletes a turn in single instance mode, the scheduler continues from the checkpoint later.
+            if more_activities:
+                helper.log_info(f'Got {activity_count} activities for {athlete_name} ({athlete_id}), continuing in the next turn.')
+            else:
+                helper.log_info(f'All done, got all activities for {athlete_name} ({athlete_id})')
+                remaining_15m, remaining_day = governor.remaining()
+                helper.log_info(f'Strava API budget left: {remaining_15m} requests in this 15 minute window, {remaining_day} today.')
+
+        except RateLimitExceeded as ex:
+            # Record when to continue and stop, the next scheduled run picks up from the last checkpoint.
+            if athlete:
+                athlete.update({'resume_after': ex.resume_after})
+                checkpoints.save(stanza, athlete, force=True)
+            helper.log_warning(f'Stopping until the Strava API rate limit has been reset at {time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ex.resume_after))}.')
+        except StravaApiError as ex:
+            helper.log_error(f'{ex}. Stopping, the next run continues from the last checkpoint.')
+        finally:
+            checkpoints.flush()
+            if response_cache and response_cache.hits + response_cache.misses:
+                helper.log_info(f'Response cache: {response_cache.hits} hits, {response_cache.misses} misses.')
+                metrics.add('cache_hits', response_cache.hits)
+                metrics.add('cache_misses', response_cache.misses)
+            # Don't start fetches that are no longer needed, and let the running ones finish before the HTTP client is closed
+            for future in list(submitted):
+                future.cancel()
+            executor.shutdown(wait=True)
+            # What the run spent its time on, for the Add-on Metrics dashboard
+            write_to_splunk(index=helper.get_output_index(), sourcetype=METRICS_SOURCETYPE, data=json.dumps(metrics.event(more_activities=more_activities)))
+            if own_http_client:
+                http_client.close()
+
+        return more_activities
 
 
 if __name__ == '__main__':
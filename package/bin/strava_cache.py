@@ -0,0 +1,80 @@
+"""Compressed on-disk cache of Strava API responses, so reindexing doesn't have to get them from Strava again."""
+import gzip
+import json
+import os
+from threading import Lock, get_ident
+
+
+class ResponseCache:
+    """Keeps JSON responses as gzip files in a directory shared by all inputs, evicting the least recently used ones.
+
+    Keys include a version of the content, e.g. a hash of the activity summary, so a changed activity gets a new key
+    instead of a stale response. Reading a response marks it as recently used by updating its modification time.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.json.gz')
+
+    def evict(self):
+        """Removes the least recently used responses until the cache is below 90% of its maximum size."""
+        entries = sorted((entry for entry in os.scandir(self.path) if entry.is_file()), key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                # Removed by another input in the meantime
+                continue
+            self.size -= size
+
+    def get(self, key):
+        """Returns the cached response for key, or None if it isn't cached."""
+        try:
+            with gzip.open(self._file(key), 'rt', encoding='utf-8') as cache_file:
+                response = json.load(cache_file)
+            os.utime(self._file(key))
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def remove(self, prefix):
+        """Removes all responses with a key that starts with prefix, e.g. everything cached for an activity that was changed."""
+        for entry in os.scandir(self.path):
+            if not (entry.name.startswith(prefix) and entry.name.endswith('.json.gz')):
+                continue
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                # Removed by another input in the meantime
+                continue
+            with self.lock:
+                self.size -= size
+
+    def put(self, key, response):
+        """Stores a response, evicting the least recently used responses when the cache has grown too large."""
+        temp_path = f'{self._file(key)}.{os.getpid()}.{get_ident()}.tmp'
+        with gzip.open(temp_path, 'wt', encoding='utf-8', compresslevel=6) as cache_file:
+            json.dump(response, cache_file, separators=(',', ':'), default=list)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, self._file(key))
+        with self.lock:
+            self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
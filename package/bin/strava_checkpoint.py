@@ -0,0 +1,47 @@
+"""Batches checkpoint writes to the KV Store."""
+import time
+
+
+class CheckpointManager:
+    """Keeps checkpoints in memory and writes them to the KV Store every flush_every saves or flush_interval seconds.
+
+    Call flush() when the input stops, including on a signal. If the process is killed before that, at most the
+    last flush_every activities (or flush_interval seconds of them) are fetched and indexed again in the next run.
+    Writes are timed as the 'checkpoint' phase and counted as checkpoint_writes if metrics are given.
+    """
+
+    def __init__(self, helper, flush_every=20, flush_interval=30, metrics=None):
+        self.helper = helper
+        self.metrics = metrics
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.saves = 0
+        self.last_flush = time.time()
+
+    def flush(self):
+        """Writes all pending checkpoints to the KV Store."""
+        started = time.perf_counter()
+        for key, state in self.pending.items():
+            self.helper.save_check_point(key, state)
+        if self.pending:
+            self.helper.log_debug(f'Saved checkpoints {list(self.pending)} after {self.saves} updates.')
+            if self.metrics:
+                self.metrics.record('checkpoint', time.perf_counter() - started)
+                self.metrics.add('checkpoint_writes', len(self.pending))
+        self.pending = {}
+        self.saves = 0
+        self.last_flush = time.time()
+
+    def get(self, key):
+        """Returns the checkpoint for key, including changes that haven't been written yet."""
+        if key in self.pending:
+            return self.pending[key]
+        return self.helper.get_check_point(key)
+
+    def save(self, key, state, force=False):
+        """Saves a checkpoint, written to the KV Store straight away with force=True or once a flush is due."""
+        self.pending[key] = state
+        self.saves += 1
+        if force or self.saves >= self.flush_every or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
@@ -0,0 +1,49 @@
+"""Pooled HTTP session used for all calls to Strava and splunkd."""
+import json
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Timeouts (connect, read) in seconds per host, splunkd can be slow to respond after a restart
+DEFAULT_TIMEOUTS = {
+    'www.strava.com': (10, 10),
+    'localhost': (10, 30),
+}
+DEFAULT_TIMEOUT = (10, 10)
+
+
+class StravaApiError(Exception):
+    """Raised when the Strava API keeps failing, so the run stops and the next one continues from the last checkpoint."""
+
+
+class HttpClient:
+    """Keeps connections to Strava and splunkd alive between requests, so they don't need a new TLS handshake every time.
+
+    Takes the same arguments as helper.send_http_request(), so it can be used in its place.
+    """
+
+    def __init__(self, pool_size=10, timeouts=None):
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        # Proxies aren't used for Strava or splunkd, so don't pick them up from the environment either
+        self.session.trust_env = False
+        adapter = HTTPAdapter(pool_connections=len(self.timeouts), pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        """Closes all pooled connections."""
+        self.session.close()
+
+    def send_http_request(self, url, method, parameters=None, payload=None, headers=None, verify=True, timeout=None, **kwargs):  # pylint: disable=too-many-arguments
+        """Sends a request using a pooled connection. Dict and list payloads are sent as JSON, others as form data."""
+        kwargs.pop('use_proxy', None)
+        if timeout is None:
+            timeout = self.timeouts.get(urlparse(url).hostname, DEFAULT_TIMEOUT)
+        if isinstance(payload, (dict, list)):
+            kwargs['data'] = json.dumps(payload)
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        elif payload:
+            kwargs['data'] = str(payload)
+        return self.session.request(method, url, params=parameters, headers=headers, verify=verify, timeout=timeout, **kwargs)
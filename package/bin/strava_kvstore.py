@@ -0,0 +1,251 @@
+"""Access to the app's KV Store collections through the splunkd REST API."""
+import contextlib
+import hashlib
+import json
+import math
+import threading
+import time
+
+KVSTORE_URL = 'https://localhost:8089/servicesNS/nobody/TA-strava-for-splunk/storage/collections/data'
+# Activity fields that change when the stream of an activity changes, e.g. after a crop or a device change
+STREAM_FIELDS = ('distance', 'moving_time', 'elapsed_time', 'device_name')
+# Segment fields copied to the strava_segments lookup as they are
+SEGMENT_FIELDS = ('name', 'distance', 'activity_type', 'average_grade', 'city', 'climb_category', 'country', 'elevation_high', 'elevation_low',
+                  'elevation_profile', 'hazardous', 'maximum_grade', 'private', 'resource_state', 'starred', 'state')
+# 16-point compass directions of a segment, each covering 22.5 degrees starting at north
+DIRECTIONS = ('N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW')
+# Segments looked up and saved per request, keeping the query short enough for a URL
+MAX_BATCH_DOCUMENTS = 100
+
+
+def content_hash(data):
+    """Returns a compact hash of JSON data that doesn't depend on the order of keys.
+
+    A list, like the streams of an activity, is encoded one item at a time, so it's never copied into a single string.
+    Arrays are encoded as lists.
+    """
+    encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=list)
+    digest = hashlib.blake2b(digest_size=16)
+    if not isinstance(data, list):
+        digest.update(encoder.encode(data).encode('utf-8'))
+        return digest.hexdigest()
+
+    digest.update(b'[')
+    for index, item in enumerate(data):
+        if index:
+            digest.update(b',')
+        digest.update(encoder.encode(item).encode('utf-8'))
+    digest.update(b']')
+    return digest.hexdigest()
+
+
+class KVStoreCollection:
+    """Reads and writes documents of a KV Store collection using the pooled HTTP client, timed as the 'kvstore' phase if metrics are given."""
+
+    def __init__(self, http_client, session_key, collection, metrics=None):
+        self.http_client = http_client
+        self.url = f'{KVSTORE_URL}/{collection}'
+        self.headers = {'Authorization': f'Splunk {session_key}'}
+        self.metrics = metrics
+
+    def _timed(self):
+        return self.metrics.time('kvstore') if self.metrics else contextlib.nullcontext()
+
+    def batch_save(self, documents):
+        """Inserts or updates documents in a single request, documents with an existing _key are replaced."""
+        if not documents:
+            return
+        with self._timed():
+            response = self.http_client.send_http_request(f'{self.url}/batch_save', "POST", headers=self.headers, payload=documents, verify=False)
+        response.raise_for_status()
+
+    def delete(self, query):
+        """Deletes all documents matching query."""
+        with self._timed():
+            response = self.http_client.send_http_request(self.url, "DELETE", parameters={'query': json.dumps(query)}, headers=self.headers, verify=False)
+        response.raise_for_status()
+
+    def query(self, query, sort=None):
+        """Returns all documents matching query."""
+        parameters = {'query': json.dumps(query)}
+        if sort:
+            parameters['sort'] = sort
+        with self._timed():
+            response = self.http_client.send_http_request(self.url, "GET", parameters=parameters, headers=self.headers, verify=False)
+        response.raise_for_status()
+        return response.json()
+
+
+class ActivityDigests(KVStoreCollection):
+    """Hashes of the activity details and stream last written for each activity, so unchanged data isn't indexed again."""
+
+    def __init__(self, http_client, session_key, metrics=None):
+        super().__init__(http_client, session_key, 'strava_activity_digests', metrics)
+
+    def get(self, activity_ids):
+        """Returns the digests of the given activities by activity ID, activities that haven't been written yet are left out.
+
+        Activities are looked up MAX_BATCH_DOCUMENTS at a time, so the query stays small for a long list of activities.
+        """
+        activity_ids = list(activity_ids)
+        digests = {}
+        for start in range(0, len(activity_ids), MAX_BATCH_DOCUMENTS):
+            query = {'$or': [{'_key': str(activity_id)} for activity_id in activity_ids[start:start + MAX_BATCH_DOCUMENTS]]}
+            digests.update((int(document['_key']), document) for document in self.query(query))
+        return digests
+
+    def remove_athlete(self, athlete_id, since=0):
+        """Removes the digests of an athlete's activities that started at or after since, so they're written again.
+
+        Returns the removed digests. Digests without a start time are removed too, as it's unknown when their activity started.
+        """
+        digests = [digest for digest in self.query({'athlete_id': str(athlete_id)}) if digest.get('start', since) >= since]
+        for start in range(0, len(digests), MAX_BATCH_DOCUMENTS):
+            self.delete({'$or': [{'_key': digest['_key']} for digest in digests[start:start + MAX_BATCH_DOCUMENTS]]})
+        return digests
+
+    @staticmethod
+    def document(activity_id, athlete_id, activity_hash, stream_key, stream_hash, segments, start):  # pylint: disable=too-many-arguments
+        """Returns the digest of an activity that was just written, as saved in the collection."""
+        return {
+            '_key': str(activity_id),
+            'athlete_id': str(athlete_id),
+            'activity_hash': activity_hash,
+            'stream_key': stream_key,
+            'stream_hash': stream_hash,
+            'segments': segments,
+            'start': start,
+            'updated': int(time.time())}
+
+    @staticmethod
+    def stream_key(activity):
+        """Returns a hash of the activity fields that change when its stream changes."""
+        return content_hash([activity.get(field) for field in STREAM_FIELDS])
+
+
+class WebhookUpdates(KVStoreCollection):
+    """Activities updated via the webhook that still have to be fetched, one document per athlete and activity."""
+
+    def __init__(self, http_client, session_key, metrics=None):
+        super().__init__(http_client, session_key, 'strava_webhook_updates', metrics)
+
+    def add(self, owner_id, activity_id):
+        """Queues an activity, repeated updates of the same activity overwrite the same document."""
+        self.batch_save([{'_key': f'{owner_id}_{activity_id}', 'owner_id': str(owner_id), 'activity_id': int(activity_id), 'received': time.time()}])
+
+    def get(self, owner_id):
+        """Returns the activities queued for an athlete with the time their last update was received, oldest update first."""
+        return {document['activity_id']: document['received'] for document in self.query({'owner_id': str(owner_id)}, sort='received')}
+
+    def remove(self, owner_id, updates):
+        """Removes fetched activities of an athlete from the queue in a single request.
+
+        updates has the received time of each activity as returned by get, an activity that was updated again since then stays queued.
+        """
+        if updates:
+            self.delete({'$or': [{'_key': f'{owner_id}_{activity_id}', 'received': {'$lte': received}} for activity_id, received in updates.items()]})
+
+
+class Segments(KVStoreCollection):
+    """The strava_segments lookup: details, bearing and direction of every segment in the written activities, and how often it was done.
+
+    Counts are kept up to date incrementally. The number of efforts per segment of each activity is kept in its digest,
+    so only the difference is added when an activity is written again. Changes are queued by worker threads and saved
+    together, adding to the counts that are in the collection at that time.
+    """
+
+    def __init__(self, http_client, session_key, metrics=None):
+        super().__init__(http_client, session_key, 'strava_segments', metrics)
+        self.lock = threading.Lock()
+        self.pending = {}
+        # Saves read and then write the counts, so only one thread saves at a time
+        self.save_lock = threading.Lock()
+
+    def _save(self, pending):
+        segment_ids = list(pending)
+        for start in range(0, len(segment_ids), MAX_BATCH_DOCUMENTS):
+            batch = segment_ids[start:start + MAX_BATCH_DOCUMENTS]
+            # Documents written by the rebuild search have a generated _key, so they're found by the segment ID
+            documents = {str(document['id']): document for document in self.query({'$or': [{'id': int(segment_id)} for segment_id in batch]})}
+            changed = []
+            for segment_id in batch:
+                change = pending[segment_id]
+                document = documents.get(segment_id)
+                if document is None:
+                    if change['segment'] is None:
+                        continue
+                    document = {'_key': segment_id, 'id': int(segment_id), 'count': 0}
+                document['count'] = max(int(document.get('count') or 0) + change['count'], 0)
+                if change['segment'] is not None:
+                    document.update(self.segment_fields(change['segment']))
+                changed.append(document)
+            self.batch_save(changed)
+
+    def add(self, activity, digest):
+        """Queues the segments of an activity. Returns the efforts per segment to keep in the activity's digest.
+
+        Activities written before their efforts were kept in the digest were already counted, e.g. by a rebuild of the
+        lookup, only new activities are counted in full. Activities without efforts, like summaries, keep their counts.
+        """
+        previous = digest.get('segments')
+        if 'segment_efforts' not in activity:
+            return previous
+        efforts = {}
+        details = {}
+        for effort in activity['segment_efforts']:
+            segment = effort.get('segment') or {}
+            if 'id' in segment:
+                efforts[str(segment['id'])] = efforts.get(str(segment['id']), 0) + 1
+                details[str(segment['id'])] = segment
+        if previous is None:
+            previous = {} if not digest else efforts
+        self.queue({segment_id: count - previous.get(segment_id, 0) for segment_id, count in efforts.items()}, details)
+        self.queue({segment_id: -count for segment_id, count in previous.items() if segment_id not in efforts})
+        return efforts
+
+    @staticmethod
+    def bearing(segment):
+        """Returns the initial bearing from the start to the end of a segment in whole degrees, or None without coordinates."""
+        try:
+            start_lat, start_lon = (math.radians(value) for value in segment['start_latlng'])
+            end_lat, end_lon = (math.radians(value) for value in segment['end_latlng'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        x = math.cos(end_lat) * math.sin(end_lon - start_lon)
+        y = math.cos(start_lat) * math.sin(end_lat) - math.sin(start_lat) * math.cos(end_lat) * math.cos(end_lon - start_lon)
+        return round(math.degrees(math.atan2(x, y))) % 360
+
+    def queue(self, counts, details=None):
+        """Queues changes to the counts of segments, with their details if known."""
+        with self.lock:
+            for segment_id, count in counts.items():
+                if not count:
+                    continue
+                change = self.pending.setdefault(segment_id, {'count': 0, 'segment': None})
+                change['count'] += count
+                if details:
+                    change['segment'] = details[segment_id]
+
+    def remove(self, digests):
+        """Queues the efforts kept in digests to be subtracted, e.g. before the activities of an athlete are indexed again."""
+        for digest in digests:
+            self.queue({segment_id: -count for segment_id, count in (digest.get('segments') or {}).items()})
+
+    def save(self):
+        """Adds the queued changes to the documents of their segments, creating documents for new segments."""
+        with self.save_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            self._save(pending)
+
+    @classmethod
+    def segment_fields(cls, segment):
+        """Returns the lookup fields of a segment, with its start and end coordinates, bearing and direction."""
+        # Booleans are kept as 'true' and 'false', as the rebuild search writes them
+        fields = {field: json.dumps(value) if isinstance(value, bool) else value for field, value in ((field, segment.get(field)) for field in SEGMENT_FIELDS)}
+        start_latlng = segment.get('start_latlng') or [None, None]
+        end_latlng = segment.get('end_latlng') or [None, None]
+        fields.update(start_latitude=start_latlng[0], start_longitude=start_latlng[1], end_latitude=end_latlng[0], end_longitude=end_latlng[1])
+        degrees = cls.bearing(segment)
+        fields.update(degrees=degrees, direction=DIRECTIONS[int((degrees + 11.25) // 22.5) % 16] if degrees is not None else None)
+        return fields
@@ -0,0 +1,103 @@
+"""Timings and counters of what an input spends its time on, written to Splunk as strava:ta:metrics events."""
+import collections
+import contextlib
+import cProfile
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+from strava_rate_limit import parse_rate_limit
+
+# Set this environment variable to a directory to write a cProfile dump of every run of an input there
+PROFILE_DIR_ENV = 'STRAVA_TA_PROFILE_DIR'
+METRICS_SOURCETYPE = 'strava:ta:metrics'
+
+
+def endpoint(url):
+    """Returns the path of a URL with IDs and stream types left out, e.g. /api/v3/activities/{id}/streams."""
+    path = re.sub(r'/streams/.*', '/streams', urlparse(url).path)
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+def profiled(name, func, *args, **kwargs):
+    """Runs func, under cProfile if PROFILE_DIR_ENV is set, writing the stats to <name>_<time>_<pid>.prof in that directory."""
+    profile_dir = os.environ.get(PROFILE_DIR_ENV)
+    if not profile_dir:
+        return func(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        os.makedirs(profile_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(profile_dir, f'{name}_{int(time.time())}_{os.getpid()}.prof'))
+
+
+class RunMetrics:
+    """Collects time spent per phase, counters, API calls by endpoint and status, and the last Strava API rate limit.
+
+    Worker threads record into the same instance, so every update is made under a lock.
+    """
+
+    def __init__(self, **dimensions):
+        self.dimensions = dimensions
+        self.lock = threading.RLock()
+        self.reset()
+
+    def add(self, counter, value=1):
+        """Adds value to a counter, e.g. the number of stream points written."""
+        with self.lock:
+            self.counters[counter] += value
+
+    def event(self, reset=False, **fields):
+        """Returns the metrics since the start or the last reset as a compact event with any extra fields, resetting them if reset is set."""
+        with self.lock:
+            event = dict(
+                self.dimensions,
+                duration=round(time.time() - self.started, 3),
+                phases={phase: {'count': count, 'seconds': round(seconds, 3)} for phase, (count, seconds) in self.phases.items()},
+                counters=dict(self.counters),
+                api_calls=[{'method': method, 'endpoint': path, 'status': status, 'count': count} for (method, path, status), count in self.api_calls.items()],
+                rate_limit=dict(self.rate_limit),
+                **fields)
+            if reset:
+                self.reset()
+            return event
+
+    def record(self, phase, seconds):
+        """Adds a timing to a phase."""
+        with self.lock:
+            timing = self.phases[phase]
+            timing[0] += 1
+            timing[1] += seconds
+
+    def record_response(self, method, url, response, streamed=False):
+        """Counts an API call by endpoint and status, the bytes received and the rate limit in the rate limit headers.
+
+        The bytes of a streamed response are counted by the caller while it reads the body.
+        """
+        with self.lock:
+            self.api_calls[(method, endpoint(url), response.status_code)] += 1
+            if not streamed:
+                self.counters['bytes_received'] += int(response.headers.get('Content-Length') or len(response.content))
+            self.rate_limit = parse_rate_limit(response.headers) or self.rate_limit
+
+    def reset(self):
+        """Starts counting from zero again, e.g. after the webhook wrote its metrics for an interval."""
+        with self.lock:
+            self.started = time.time()
+            self.phases = collections.defaultdict(lambda: [0, 0.0])
+            self.counters = collections.Counter()
+            self.api_calls = collections.Counter()
+            self.rate_limit = {}
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        """Times the block as a phase, e.g. 'api' or 'parse'."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - started)
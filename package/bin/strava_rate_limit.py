@@ -0,0 +1,172 @@
+"""Shares the Strava API rate limit between all Strava inputs running on this Splunk instance."""
+import json
+import os
+import time
+from contextlib import contextmanager, suppress
+from threading import get_ident
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows, the state file is locked with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+WINDOW_15M = 900
+WINDOW_DAY = 86400
+# Strava's default read limits, used until a response tells us otherwise
+DEFAULT_LIMIT_15M = 100
+DEFAULT_LIMIT_DAY = 1000
+
+
+def parse_rate_limit(headers):
+    """Returns the usage and limit of the 15-minute and daily windows from the rate limit headers of a Strava response, or None without them.
+
+    Strava has an overall limit in the X-RateLimit headers and a lower limit for reads (GET requests) in the
+    X-ReadRateLimit headers. Nearly all requests of the add-on are reads, so for each window the pair of usage and
+    limit with the fewest requests left counts.
+    """
+    windows = []
+    for prefix in ('X-RateLimit', 'X-ReadRateLimit'):
+        try:
+            usage = [int(value) for value in headers[f'{prefix}-Usage'].split(',')]
+            limit = [int(value) for value in headers[f'{prefix}-Limit'].split(',')]
+        except (KeyError, ValueError):
+            continue
+        if len(usage) == len(limit) == 2:
+            windows.append((usage, limit))
+    if not windows:
+        return None
+    usage_15m, limit_15m = min(((usage[0], limit[0]) for usage, limit in windows), key=lambda pair: pair[1] - pair[0])
+    usage_day, limit_day = min(((usage[1], limit[1]) for usage, limit in windows), key=lambda pair: pair[1] - pair[0])
+    return {'usage_15m': usage_15m, 'limit_15m': limit_15m, 'usage_day': usage_day, 'limit_day': limit_day}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when the Strava API rate limit has been reached, resume_after is the epoch timestamp when it resets."""
+
+    def __init__(self, resume_after):
+        super().__init__(f'Strava API rate limit reached, resume after {resume_after}')
+        self.resume_after = resume_after
+
+
+def lock_file(file):
+    """Takes an exclusive lock on an open file, waiting for other processes. Returns False if it couldn't be locked."""
+    if fcntl:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return True
+    # msvcrt locks bytes from the current position and gives up after trying for 10 seconds
+    file.seek(0)
+    try:
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def unlock_file(file):
+    """Releases the lock taken by lock_file."""
+    if fcntl:
+        fcntl.flock(file, fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class RateLimitGovernor:
+    """Keeps track of the 15-minute and daily Strava API windows in a state file shared by all processes.
+
+    Every request takes a token from both windows before it's sent and the rate limit headers of every response
+    correct the usage. When a window is used up, requests wait until Strava resets it instead of running into a 429,
+    or raise RateLimitExceeded when that's longer than the caller wants to wait.
+    """
+
+    def __init__(self, path, helper, margin=2):
+        self.path = path
+        self.helper = helper
+        # Requests kept spare in each window, e.g. for token refreshes of other inputs
+        self.margin = margin
+
+    @contextmanager
+    def _locked_state(self):
+        """Yields the shared state while holding the lock, and saves it afterwards.
+
+        When the state can't be locked or saved, e.g. while a virus scanner has the file open on Windows, it's only
+        used for this request. The rate limit headers of the next response correct the usage again.
+        """
+        with open(f'{self.path}.lock', 'a', encoding='utf-8') as state_lock:
+            locked = lock_file(state_lock)
+            if not locked:
+                self.helper.log_warning('Could not lock the shared Strava API rate limit state, using it without the lock.')
+            try:
+                try:
+                    with open(self.path, encoding='utf-8') as state_file:
+                        state = json.load(state_file)
+                except (OSError, ValueError):
+                    state = {}
+                self._roll_windows(state, int(time.time()))
+                yield state
+                # A temporary file per thread, so a writer that didn't get the lock can't replace another one's file
+                temp_path = f'{self.path}.{os.getpid()}.{get_ident()}.tmp'
+                try:
+                    with open(temp_path, 'w', encoding='utf-8') as state_file:
+                        json.dump(state, state_file)
+                    os.replace(temp_path, self.path)
+                except OSError as ex:
+                    self.helper.log_warning(f'Could not save the shared Strava API rate limit state: {ex}')
+                    with suppress(OSError):
+                        os.remove(temp_path)
+            finally:
+                if locked:
+                    unlock_file(state_lock)
+
+    @staticmethod
+    def _roll_windows(state, now):
+        """Resets the usage of windows that have passed. Strava's windows start every quarter hour and at midnight UTC."""
+        window_15m = now - now % WINDOW_15M
+        window_day = now - now % WINDOW_DAY
+        if state.get('window_15m') != window_15m:
+            state.update({'window_15m': window_15m, 'usage_15m': 0})
+        if state.get('window_day') != window_day:
+            state.update({'window_day': window_day, 'usage_day': 0})
+        state.setdefault('limit_15m', DEFAULT_LIMIT_15M)
+        state.setdefault('limit_day', DEFAULT_LIMIT_DAY)
+
+    def acquire(self, max_wait=None):
+        """Waits until both windows have a request left and takes it. Raises RateLimitExceeded if that takes longer than max_wait seconds."""
+        while True:
+            delay = self.reserve()
+            if not delay:
+                return
+            if max_wait is not None and delay > max_wait:
+                raise RateLimitExceeded(int(time.time()) + delay)
+            self.helper.log_warning(f'Strava API budget used up for this window, waiting {delay} seconds before the next request.')
+            time.sleep(delay)
+
+    def remaining(self):
+        """Returns the number of requests left in the 15-minute and daily windows."""
+        with self._locked_state() as state:
+            return state['limit_15m'] - state['usage_15m'], state['limit_day'] - state['usage_day']
+
+    def reserve(self):
+        """Takes a request from both windows. Returns 0 if the request can be sent, otherwise the seconds until a window resets."""
+        with self._locked_state() as state:
+            now = int(time.time())
+            if state['usage_day'] >= state['limit_day'] - self.margin:
+                return state['window_day'] + WINDOW_DAY - now + 5
+            if state['usage_15m'] >= state['limit_15m'] - self.margin:
+                return state['window_15m'] + WINDOW_15M - now + 5
+            state['usage_15m'] += 1
+            state['usage_day'] += 1
+            return 0
+
+    def update(self, headers):
+        """Updates the shared usage and limits from the rate limit headers of a Strava response."""
+        rate_limit = parse_rate_limit(headers)
+        if rate_limit is None:
+            return
+
+        with self._locked_state() as state:
+            # Other processes may have sent requests since this response, so never lower the usage
+            state.update(rate_limit, usage_15m=max(state['usage_15m'], rate_limit['usage_15m']), usage_day=max(state['usage_day'], rate_limit['usage_day']))
+        self.helper.log_debug(f"Strava API usage: {rate_limit['usage_15m']}/{rate_limit['limit_15m']} (15min), {rate_limit['usage_day']}/{rate_limit['limit_day']} (24h).")
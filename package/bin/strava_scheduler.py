@@ -0,0 +1,100 @@
+"""Runs all Strava athlete inputs from a single long-lived process."""
+import heapq
+import itertools
+import signal
+import sys
+import time
+
+from strava_http import HttpClient
+
+DEFAULT_INTERVAL = 3600
+# Activities fetched for an athlete before the next athlete gets a turn
+ACTIVITIES_PER_TURN = 60
+
+
+class StanzaHelper:
+    """Wraps the single instance helper so it behaves like the helper of a single input stanza."""
+
+    def __init__(self, helper, stanza):
+        self._helper = helper
+        self._stanza = stanza
+        self.use_single_instance = False
+
+    def __getattr__(self, name):
+        return getattr(self._helper, name)
+
+    def get_arg(self, arg_name):
+        """Returns the argument of this stanza, in single instance mode the helper returns a dict of all stanzas."""
+        args = self._helper.get_arg(arg_name)
+        return args.get(self._stanza) if isinstance(args, dict) else args
+
+    def get_input_stanza(self, input_stanza_name=None):  # pylint: disable=unused-argument
+        """Returns only this stanza and its arguments, like the helper of a single input stanza."""
+        return {self._stanza: self._helper.get_input_stanza(self._stanza)}
+
+    def get_output_index(self, input_stanza_name=None):  # pylint: disable=unused-argument
+        """Returns the index of this stanza."""
+        return self._helper.get_output_index(self._stanza)
+
+    def get_sourcetype(self, input_stanza_name=None):  # pylint: disable=unused-argument
+        """Returns the sourcetype of this stanza."""
+        return self._helper.get_sourcetype(self._stanza)
+
+    def new_event(self, data, source=None, **kwargs):
+        """Creates an event with the stanza as source, like Splunk does for inputs that run in their own process."""
+        return self._helper.new_event(data, source=source or f'{self._helper.get_input_type()}://{self._stanza}', **kwargs)
+
+
+class AthleteScheduler:
+    """Runs every athlete stanza when it's due, ordered by a priority queue on the next due time.
+
+    Athletes share one HTTP connection pool, and the rate limit budget through the shared rate limit state file.
+    Each turn gets at most ACTIVITIES_PER_TURN activities, after which an athlete with more activities to get goes to
+    the back of the queue, so a large backfill doesn't hold up the other athletes.
+    """
+
+    def __init__(self, helper, ew, collect_athlete):
+        self.helper = helper
+        self.ew = ew
+        self.collect_athlete = collect_athlete
+        self.http_client = HttpClient(pool_size=10)
+        # Tie-breaker so athletes that are due at the same time run in the order they were queued
+        self.sequence = itertools.count()
+        self.queue = []
+
+    def get_interval(self, stanza):
+        """Returns the interval of a stanza in seconds."""
+        try:
+            return int(StanzaHelper(self.helper, stanza).get_arg('interval'))
+        except (TypeError, ValueError):
+            return DEFAULT_INTERVAL
+
+    def run(self):
+        """Runs athletes as they become due, until Splunk stops the input."""
+        signal.signal(signal.SIGTERM, self.stop)
+        stanzas = list(self.helper.get_input_stanza())
+        self.helper.log_info(f'Running {len(stanzas)} athletes in a single process: {", ".join(stanzas)}.')
+        now = time.time()
+        for stanza in stanzas:
+            heapq.heappush(self.queue, (now, next(self.sequence), stanza))
+
+        while self.queue:
+            due, _, stanza = heapq.heappop(self.queue)
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                more_activities = self.collect_athlete(StanzaHelper(self.helper, stanza), self.ew, http_client=self.http_client, max_activities=ACTIVITIES_PER_TURN)
+            except Exception as ex:  # pylint: disable=broad-except
+                # Don't let one athlete stop the others, try again at the next interval.
+                self.helper.log_error(f'Error getting activities for {stanza}: {ex}')
+                more_activities = False
+
+            next_due = time.time() if more_activities else time.time() + self.get_interval(stanza)
+            heapq.heappush(self.queue, (next_due, next(self.sequence), stanza))
+
+    def stop(self, signum, frame):  # pylint: disable=unused-argument
+        """Exits when Splunk stops the input, the athlete that is running saves its checkpoints on the way out."""
+        self.helper.log_info('Input is being stopped, saving checkpoints.')
+        sys.exit(0)
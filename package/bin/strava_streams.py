@@ -0,0 +1,264 @@
+"""Turns Strava activity streams into events, shared by the Strava API input and the webhook."""
+import itertools
+import json
+import math
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # numpy isn't part of Splunk's bundled Python, plain lists are used instead
+    np = None
+
+try:
+    import ijson
+except ImportError:  # ijson is included in lib, without it the whole response is parsed at once instead
+    ijson = None
+
+# Placeholder for values missing from shorter streams
+MISSING = object()
+# Streams requested for every activity
+STREAM_TYPES = ('time', 'distance', 'latlng', 'altitude', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'temp', 'moving', 'grade_smooth')
+# Streams that keep the value of the first point when points are merged, instead of the average
+FIRST_VALUE_STREAMS = ('distance', 'lat', 'lon', 'moving')
+# Mean earth radius in metres, used to project latlng onto a plane for track simplification
+EARTH_RADIUS = 6371008.8
+# Streams written as measurements when the stream format is 'metrics'
+METRIC_STREAMS = ('distance', 'altitude', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'temp', 'grade_smooth')
+# Bytes read at a time from a streams response
+CHUNK_SIZE = 64 * 1024
+# Array type codes for streams of only ints or only floats, 8 bytes per value instead of a Python object each
+TYPECODES = {int: 'q', float: 'd'}
+
+
+def build_events(epochs, columns, activity_id, athlete_id, stream_format='points', pack_size=500):  # pylint: disable=too-many-arguments
+    """Returns the sourcetype and a generator of events for the stream in the given stream format."""
+    if stream_format == 'packed':
+        return 'strava:activities:stream:packed', build_packed_stream_events(epochs, columns, activity_id, pack_size)
+    if stream_format == 'metrics':
+        return 'strava:activities:metrics', build_metric_events(format_timestamps(epochs), columns, activity_id, athlete_id)
+    return 'strava:activities:stream', build_stream_events(format_timestamps(epochs), columns, activity_id)
+
+
+def build_metric_events(timestamps, columns, activity_id, athlete_id):
+    """Yields one multi-measurement metric data point per stream point, with activity_id and athlete_id as dimensions."""
+    measures = {f'strava.{key}': column for key, column in columns.items() if key in METRIC_STREAMS}
+    for event in build_stream_events(timestamps, measures, str(activity_id)):
+        event['athlete_id'] = str(athlete_id)
+        yield {key: value for key, value in event.items() if value is not None}
+
+
+def build_packed_stream_events(epochs, columns, activity_id, pack_size):
+    """Yields one event per window of pack_size points, with every stream as an array and time as offsets from the first point."""
+    for start in range(0, len(epochs), pack_size):
+        # Streams longer than the time stream are cut off at its end, like in the other formats
+        end = min(start + pack_size, len(epochs))
+        window = epochs[start:end]
+        event = {
+            'time': format_timestamps(window[:1])[0],
+            'activity_id': activity_id,
+            'points': len(window),
+            'offset': [epoch - window[0] for epoch in window]}
+        for key, column in columns.items():
+            values = column[start:end]
+            if values:
+                event[key] = list(values)
+        yield event
+
+
+def build_stream_events(timestamps, columns, activity_id):
+    """Yields one event per stream point, built row by row from the stream columns."""
+    keys = ('time', *columns)
+    if streams_aligned(timestamps, columns):
+        for row in zip(timestamps, *columns.values()):
+            event = dict(zip(keys, row))
+            event['activity_id'] = activity_id
+            yield event
+        return
+
+    # Streams of different lengths: stop at the end of the time stream and leave out values a stream doesn't have.
+    rows = itertools.islice(itertools.zip_longest(timestamps, *columns.values(), fillvalue=MISSING), len(timestamps))
+    for row in rows:
+        event = {key: value for key, value in zip(keys, row) if value is not MISSING}
+        event['activity_id'] = activity_id
+        yield event
+
+
+def compact(values):
+    """Returns a stream's values as an array if they're all ints or all floats, otherwise as they are."""
+    typecode = TYPECODES.get(type(values[0])) if values else None
+    if typecode and all(type(value) is type(values[0]) for value in values):  # pylint: disable=unidiomatic-typecheck
+        return array(typecode, values)
+    return values
+
+
+def downsample(epochs, columns, interval=0, tolerance=0):
+    """Merges consecutive stream points, returns the epochs and columns of the merged points.
+
+    A merged point starts every interval seconds, and at every point needed to keep the track within tolerance metres.
+    Numeric streams are averaged over the merged points, distance, latlng and moving keep the value of the first point.
+    """
+    starts = set()
+    if interval:
+        bucket = None
+        for index, epoch in enumerate(epochs):
+            if (epoch - epochs[0]) // interval != bucket:
+                bucket = (epoch - epochs[0]) // interval
+                starts.add(index)
+    if tolerance and 'lat' in columns:
+        starts.update(simplify_track(columns['lat'], columns['lon'], tolerance))
+    if not starts:
+        return epochs, columns
+
+    starts = sorted(starts | {0})
+    ends = starts[1:] + [len(epochs)]
+    downsampled = {}
+    for key, column in columns.items():
+        if key in FIRST_VALUE_STREAMS:
+            downsampled[key] = [column[start] for start in starts if start < len(column)]
+            continue
+        values = []
+        for start, end in zip(starts, ends):
+            if start >= len(column):
+                break
+            points = [value for value in column[start:end] if value is not None]
+            values.append(round(sum(points) / len(points), 2) if points else None)
+        downsampled[key] = values
+
+    return [epochs[start] for start in starts], downsampled
+
+
+def format_timestamps(epochs):
+    """Formats a list of epoch timestamps as Strava-style UTC timestamps."""
+    if np is not None:
+        return np.char.add(np.datetime_as_string(np.asarray(epochs, dtype='datetime64[s]')), 'Z').tolist()
+    return [time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch)) for epoch in epochs]
+
+
+def get_stream_columns(data, activity_start_date):
+    """Returns the epoch timestamps of the stream and a dict of the other streams as columns, with latlng split into lat and lon."""
+    columns = {stream['type']: stream['data'] for stream in data if stream.get('data')}
+    offsets = columns.pop('time', None)
+    if not offsets:
+        return None, columns
+
+    # Add the start time to the whole time column at once
+    if np is not None:
+        epochs = (np.asarray(offsets, dtype='int64') + int(activity_start_date)).tolist()
+    else:
+        epochs = [offset + activity_start_date for offset in offsets]
+
+    latlng = columns.pop('latlng', None)
+    if latlng:
+        columns['lat'], columns['lon'] = zip(*latlng)
+
+    return epochs, columns
+
+
+def get_stream_types(value):
+    """Returns the stream types to request from a comma-separated list, all of them by default. The time stream is always included."""
+    if not value:
+        return STREAM_TYPES
+    types = [stream_type.strip() for stream_type in value.split(',') if stream_type.strip() in STREAM_TYPES]
+    return ('time', *(stream_type for stream_type in types if stream_type != 'time'))
+
+
+def parse_streams(chunks):
+    """Parses a streams response from its body in chunks of bytes, with the values of numeric streams as arrays.
+
+    Returns a list of streams, also for a response keyed by stream type. With ijson, every stream is parsed as soon as
+    it has been received and compacted before the next one is read, so the response body and all streams as Python
+    lists are never in memory at the same time.
+    """
+    if ijson is None:
+        streams = json.loads(b''.join(chunks))
+        if isinstance(streams, dict):
+            streams = [dict(stream, type=stream_type) for stream_type, stream in streams.items()]
+        for stream in streams:
+            stream['data'] = compact(stream.get('data'))
+        return streams
+
+    # Streams keyed by type are an object, otherwise they're a list
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+    keyed = head.lstrip()[:1] == b'{'
+
+    streams = []
+    parsed = ijson.sendable_list()
+    parser = ijson.kvitems_coro(parsed, '', use_float=True) if keyed else ijson.items_coro(parsed, 'item', use_float=True)
+    for chunk in itertools.chain([head], chunks, [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.send(chunk)
+        for stream in parsed:
+            if keyed:
+                stream_type, stream = stream
+                stream['type'] = stream_type
+            stream['data'] = compact(stream.get('data'))
+            streams.append(stream)
+        del parsed[:]
+    return streams
+
+
+def simplify_track(lat, lon, tolerance):
+    """Returns the indices of the track points kept by Ramer-Douglas-Peucker simplification with a tolerance in metres."""
+    count = min(len(lat), len(lon))
+    if count < 3:
+        return list(range(count))
+
+    # Equirectangular projection around the start, accurate enough at the scale of an activity
+    scale = math.cos(math.radians(lat[0])) * EARTH_RADIUS
+    if np is not None:
+        xs = np.radians(np.asarray(lon[:count], dtype='float64')) * scale
+        ys = np.radians(np.asarray(lat[:count], dtype='float64')) * EARTH_RADIUS
+    else:
+        xs = [math.radians(value) * scale for value in lon[:count]]
+        ys = [math.radians(value) * EARTH_RADIUS for value in lat[:count]]
+
+    keep = {0, count - 1}
+    # Iterative instead of recursive, tracks with many points would exceed the recursion limit
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        index, distance = _farthest_point(xs, ys, first, last)
+        if distance > tolerance:
+            keep.add(index)
+            stack.extend(((first, index), (index, last)))
+
+    return sorted(keep)
+
+
+def streams_aligned(timestamps, columns):
+    """Returns True if every stream has a value for every point of the time stream."""
+    return all(len(column) == len(timestamps) for column in columns.values())
+
+
+def _farthest_point(xs, ys, first, last):
+    """Returns the index and distance of the point between first and last that is farthest from the line between them."""
+    dx = xs[last] - xs[first]
+    dy = ys[last] - ys[first]
+    length = dx * dx + dy * dy
+    if np is not None:
+        px = xs[first + 1:last] - xs[first]
+        py = ys[first + 1:last] - ys[first]
+        position = np.clip((px * dx + py * dy) / length, 0, 1) if length else 0
+        distances = np.hypot(px - position * dx, py - position * dy)
+        index = int(np.argmax(distances))
+        return first + 1 + index, float(distances[index])
+
+    index, farthest = first, 0
+    for point in range(first + 1, last):
+        px = xs[point] - xs[first]
+        py = ys[point] - ys[first]
+        position = min(max((px * dx + py * dy) / length, 0), 1) if length else 0
+        distance = math.hypot(px - position * dx, py - position * dy)
+        if distance > farthest:
+            index, farthest = point, distance
+    return index, farthest
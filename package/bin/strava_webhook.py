@@ -1,15 +1,36 @@
 import sys
+import calendar
 import json
+import os
+import queue
 import ssl
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs, urlparse
-from threading import Thread
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+from threading import Lock, Thread
 
 import helper_strava_webhook as hsw
+from splunklib import client
+from strava_cache import ResponseCache
+from strava_http import HttpClient
+from strava_kvstore import ActivityDigests, Segments, WebhookUpdates, content_hash
+from strava_metrics import METRICS_SOURCETYPE, RunMetrics
+from strava_rate_limit import RateLimitGovernor
+from strava_streams import CHUNK_SIZE, build_events, downsample, get_stream_columns, get_stream_types, parse_streams
 
 unicode = str  # pylint: disable=invalid-name
 
+# Events waiting to be handled, Strava gets a 503 and retries when the queue is full
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 4
+# Seconds without new events for an athlete before their input is reloaded
+DEFAULT_RELOAD_DELAY = 10
+# Seconds without new events for an activity before it's fetched directly
+FETCH_DELAY = 2
+# Seconds between strava:ta:metrics events of the webhook
+METRICS_INTERVAL = 300
+
 
 class StravaWebhook(hsw.STRAVA_WEBHOOK):
     """Inherits helper_strava_api class and overwrites collect_events() function."""
@@ -20,11 +41,12 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
         class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
             """Handles incoming requests from the browser"""
 
-            SESSION_KEY = helper.context_meta['session_key']
-            SSL_VERIFY = False
+            # Don't let a client that stops sending hold up a thread forever
+            timeout = 10
 
             def handle_request(self):
-                """Parses incoming POST, saves as checkpoint and sends data to Splunk"""
+                """Validates incoming POST, queues it for the workers and acknowledges it straight away"""
+                received = time.time()
                 try:
                     content_type = self.headers.get('content-type')
 
@@ -41,39 +63,26 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
                         self.write_empty_response(400)
                         return
 
+                    if not isinstance(message, dict) or not all(field in message for field in ('aspect_type', 'object_id', 'object_type', 'owner_id')):
+                        self.write_empty_response(400)
+                        return
+
                     helper.log_info(f'Incoming POST from {self.client_address[0]}: {message}')
 
-                    aspect_type = message['aspect_type']
-                    object_id = message['object_id']
-                    object_type = message['object_type']
-                    # make owner_id a str to avoid issues with athlete_checkpoint dict
-                    owner_id = str(message['owner_id'])
-
-                    athlete_checkpoint = helper.get_check_point("webhook_updates") or {}
-
-                    # We only care about activity updates. New activities are pulled in automatically as strava_api input restarts.
-                    if aspect_type == 'update' and object_type == 'activity':
-                        if owner_id not in athlete_checkpoint:
-                            athlete_checkpoint[owner_id] = []
-                            athlete_checkpoint[owner_id].append(object_id)
-                            helper.save_check_point("webhook_updates", athlete_checkpoint)
-                        else:
-                            athlete_checkpoint[owner_id].append(object_id)
-                            helper.save_check_point("webhook_updates", athlete_checkpoint)
-                        helper.log_debug(f'webhooks_updates checkpoint: {helper.get_check_point("webhook_updates")}')
-
-                    # Send data to Splunk
-                    data = json.dumps(message)
-                    event = helper.new_event(source=helper.get_input_type(), index=helper.get_output_index(), sourcetype=helper.get_sourcetype(), data=data)
-                    ew.write_event(event)
+                    try:
+                        work_queue.put_nowait((received, message))
+                    except queue.Full:
+                        # Strava retries deliveries that don't get a 200
+                        helper.log_warning(f'Webhook queue is full ({WEBHOOK_QUEUE_SIZE} events), asking Strava to retry later.')
+                        self.write_empty_response(503)
+                        metrics.add('events_rejected')
+                        return
 
-                    # Strava API expects a 200 response
+                    # Strava API expects a 200 response within 2 seconds
                     self.write_empty_response(200)
-
-                    # Restart strava_api inputs to pull in the data unless it's a delete, as the input doesn't do anything with that anyway.
-                    if aspect_type != 'delete':
-                        self.restart_input('strava_api', self.SESSION_KEY)
-                        helper.log_info(f'Reloading Strava API input to retrieve updated activity {object_id} for athlete {owner_id}.')
+                    metrics.record('ack', time.time() - received)
+                    metrics.add('events_received')
+                    helper.log_debug(f'Acknowledged webhook event in {(time.time() - received) * 1000:.1f} ms, queue depth {work_queue.qsize()}.')
 
                 except Exception as ex:
                     helper.log_error(f'Something went wrong in handle request: {ex}')
@@ -99,17 +108,6 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
                 """Used for incoming POST request"""
                 self.handle_request()
 
-            def restart_input(self, modinput, session_key):
-                """Restarts modinput, used to trigger the Strava Activities input to pull in update."""
-                rest_url = f'https://localhost:8089/services/data/inputs/{modinput}/_reload'
-                headers = {'Authorization': f'Splunk {session_key}'}
-
-                response = requests.get(rest_url, headers=headers, verify=self.SSL_VERIFY, timeout=10)
-                try:
-                    response.raise_for_status()
-                except Exception as ex:
-                    helper.log_error(f'Something went wrong in input function: {ex}')
-
             def write_response(self, status_code, json_body):
                 """Craft response header with status code and json_body"""
                 self.send_response(status_code)
@@ -131,6 +129,28 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
 
                 self.wfile.write(content)
 
+        class ThreadingHTTPSServer(ThreadingHTTPServer):
+            """Handles every request in its own thread, including the TLS handshake, so a slow client doesn't hold up others."""
+
+            daemon_threads = True
+            # Strava sends bursts of events, keep room for them in the listen backlog
+            request_queue_size = 128
+
+            def __init__(self, server_address, handler_class, ssl_context):
+                super().__init__(server_address, handler_class)
+                self.ssl_context = ssl_context
+
+            def finish_request(self, request, client_address):
+                request.settimeout(SimpleHTTPRequestHandler.timeout)
+                request = self.ssl_context.wrap_socket(request, server_side=True)
+                super().finish_request(request, client_address)
+
+        def counted(chunks):
+            """Passes on the chunks of a response body, counting the bytes received."""
+            for chunk in chunks:
+                metrics.add('bytes_received', len(chunk))
+                yield chunk
+
         def create_webhook(client_id, client_secret, verify_token, callback_url):
             """Creates webhook, raises error if one already exists"""
             url = 'https://www.strava.com/api/v3/push_subscriptions'
@@ -139,7 +159,7 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
                 'client_secret': client_secret,
                 'verify_token': verify_token,
                 'callback_url': callback_url}
-            response = helper.send_http_request(url, "POST", payload=payload, use_proxy=False)
+            response = http_client.send_http_request(url, "POST", payload=payload)
 
             try:
                 response.raise_for_status()
@@ -157,13 +177,169 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
                 response = response.json()
                 helper.log_info(f"Webhook created successfully: ID {response['id']}")
 
+        def fetch_activities():
+            """Fetches the activities whose updates have settled, runs in its own thread."""
+            while True:
+                time.sleep(1)
+                now = time.time()
+                with fetch_lock:
+                    # An activity that is still being fetched stays pending, so it's never fetched by two workers at once
+                    due = [key for key, (first_seen, last_seen, _) in pending_fetches.items()
+                           if key not in fetching and (now - last_seen >= FETCH_DELAY or now - first_seen >= FETCH_DELAY * 6)]
+                    for key in due:
+                        fetching.add(key)
+                    due = [(*key, pending_fetches.pop(key)[2]) for key in due]
+                for owner_id, activity_id, updated in due:
+                    fetch_executor.submit(fetch_settled, owner_id, activity_id, updated)
+
+        def fetch_activity(owner_id, activity_id):
+            """Gets an activity and its stream and writes them to the index of the athlete's input. Returns False if the input has to get it instead."""
+            athlete_input = find_input(owner_id)
+            if not athlete_input:
+                helper.log_warning(f'No Strava Activities input found for athlete {owner_id}, leaving activity {activity_id} to the input.')
+                return False
+            stanza = athlete_input['name']
+            settings = athlete_input['content']
+
+            access_token = get_access_token(stanza)
+            if not access_token:
+                return False
+
+            started = time.time()
+            metrics.add('direct_fetches')
+            # The inputs would otherwise get the details from before the update from their cache on a reindex
+            if response_cache:
+                response_cache.remove(f'{activity_id}-')
+            activity = strava_request(f'https://www.strava.com/api/v3/activities/{activity_id}?include_all_efforts=true', "GET", access_token)
+            if not activity:
+                return False
+
+            # Events look the same as the ones written by the athlete's input, and only what changed since they were last written is written.
+            source = f'strava_api://{stanza}'
+            index = settings.get('index') or 'default'
+            digest = activity_digests.get([activity_id]).get(activity_id, {})
+            start = calendar.timegm(time.strptime(activity['start_date'], '%Y-%m-%dT%H:%M:%SZ'))
+            activity_hash = content_hash(activity)
+            events = []
+            if activity_hash != digest.get('activity_hash'):
+                events.append(helper.new_event(source=source, index=index, sourcetype=settings.get('sourcetype') or 'strava:activities', data=json.dumps(activity)))
+
+            # The stream is only requested when the activity is new or its distance, duration or device changed.
+            # The stream key only changes once the stream has been written, so a stream that failed is requested again next time.
+            new_stream_key = ActivityDigests.stream_key(activity)
+            stream_key = digest.get('stream_key')
+            stream_hash = digest.get('stream_hash')
+            if new_stream_key != stream_key:
+                types = ','.join(get_stream_types(settings.get('stream_types')))
+                series_type = settings.get('stream_series_type') or 'time'
+                resolution = settings.get('stream_resolution') or 'high'
+                params = {'series_type': series_type, 'resolution': resolution, 'key_by_type': 'true'}
+                stream_data = strava_request(f'https://www.strava.com/api/v3/activities/{activity_id}/streams/{types}', "GET", access_token, parse=parse_streams, parameters=params)
+
+                if stream_data and content_hash(stream_data) == stream_hash:
+                    stream_key = new_stream_key
+                with metrics.time('parse'):
+                    epochs, columns = get_stream_columns(stream_data, start) if stream_data and stream_key != new_stream_key else (None, None)
+                    if epochs and (settings.get('downsample_interval') or settings.get('latlng_tolerance')):
+                        epochs, columns = downsample(epochs, columns, int(settings.get('downsample_interval') or 0), float(settings.get('latlng_tolerance') or 0))
+                    if epochs:
+                        stream_format = settings.get('stream_format') or 'points'
+                        if stream_format == 'metrics' and not settings.get('metrics_index'):
+                            helper.log_error(f'Stream format Metrics of input {stanza} requires a Metrics index, writing one event per point instead.')
+                            stream_format = 'points'
+                        sourcetype, stream_events = build_events(epochs, columns, activity_id, owner_id, stream_format, int(settings.get('stream_pack_size') or 500))
+                        stream_index = settings.get('metrics_index') if stream_format == 'metrics' else index
+                        events.extend(helper.new_event(source=source, index=stream_index, sourcetype=sourcetype, data=json.dumps(event)) for event in stream_events)
+                        stream_hash = content_hash(stream_data)
+                        stream_key = new_stream_key
+                        metrics.add('stream_points', len(epochs))
+
+            with metrics.time('write'), write_lock:
+                for event in events:
+                    ew.write_event(event)
+            metrics.add('events_written', len(events))
+            activity_digests.batch_save([ActivityDigests.document(activity_id, owner_id, activity_hash, stream_key, stream_hash, segments.add(activity, digest), start)])
+            segments.save()
+            helper.log_info(f'Fetched activity {activity_id} for athlete {owner_id} directly in {(time.time() - started) * 1000:.0f} ms, {len(events)} events.')
+            return True
+
+        def fetch_settled(owner_id, activity_id, updated):
+            """Fetches an activity directly, or leaves it to the athlete's input when that fails."""
+            fetched = False
+            try:
+                fetched = fetch_activity(owner_id, activity_id)
+            except Exception as ex:
+                helper.log_warning(f'Could not fetch activity {activity_id} for athlete {owner_id} directly, leaving it to the input: {ex}')
+            finally:
+                with fetch_lock:
+                    fetching.discard((owner_id, activity_id))
+            if fetched:
+                return
+            # New activities are pulled in by the input anyway, updates of older ones have to be queued for it
+            try:
+                if updated:
+                    webhook_updates.add(owner_id, activity_id)
+            finally:
+                schedule_reload(owner_id)
+
+        def find_input(owner_id):
+            """Returns the strava_api input entry (name and content) for an athlete, by looking up the athlete ID in each input's checkpoint."""
+            if owner_id not in athlete_inputs:
+                url = 'https://localhost:8089/servicesNS/nobody/TA-strava-for-splunk/data/inputs/strava_api'
+                headers = {'Authorization': f'Splunk {helper.context_meta["session_key"]}'}
+                response = http_client.send_http_request(url, "GET", parameters={'output_mode': 'json', 'count': 0}, headers=headers, verify=False)
+                try:
+                    response.raise_for_status()
+                except Exception as ex:
+                    helper.log_error(f'Something went wrong listing Strava API inputs: {ex}')
+                    return None
+                for entry in response.json()['entry']:
+                    athlete = helper.get_check_point(entry['name']) or {}
+                    if 'id' in athlete:
+                        athlete_inputs[str(athlete['id'])] = entry
+            return athlete_inputs.get(owner_id)
+
+        def get_access_token(stanza):
+            """Returns the access token of the athlete of a strava_api input, refreshing and storing it if it has expired."""
+            with token_lock:
+                athlete_oauth = tokens.get(stanza)
+                if athlete_oauth and time.time() < athlete_oauth['expires_at'] - 60:
+                    return athlete_oauth['access_token']
+
+                # The athlete's input may have refreshed the token since it was cached, which makes the cached refresh token invalid
+                tokens.pop(stanza, None)
+                try:
+                    stored_secret = service.storage_passwords[f':{stanza}:']
+                except KeyError:
+                    helper.log_warning(f'No OAuth details stored for input {stanza} yet, leaving activities to the input.')
+                    return None
+                athlete_oauth = json.loads(stored_secret.content.clear_password)
+
+                if time.time() >= athlete_oauth['expires_at'] - 60:
+                    payload = {
+                        'client_id': client_id,
+                        'client_secret': client_secret,
+                        'refresh_token': athlete_oauth['refresh_token'],
+                        'grant_type': 'refresh_token'}
+                    response = strava_request('https://www.strava.com/api/v3/oauth/token', "POST", payload=payload)
+                    athlete_oauth = {
+                        "access_token": response['access_token'],
+                        "refresh_token": response['refresh_token'],
+                        "expires_at": response['expires_at']}
+                    # The athlete's input picks up the refreshed token from the same secret, updated in place so it's never missing
+                    stored_secret.update(password=json.dumps(athlete_oauth))
+                    helper.log_info(f'Successfully refreshed Strava token for input {stanza}.')
+
+                tokens[stanza] = athlete_oauth
+                return athlete_oauth['access_token']
+
         def get_webhook(client_id, client_secret):
             """Gets webhook details"""
             url = 'https://www.strava.com/api/v3/push_subscriptions'
             payload = {
                 'client_id': client_id,
                 'client_secret': client_secret}
-            response = helper.send_http_request(url, "GET", payload=payload, use_proxy=False)
+            response = http_client.send_http_request(url, "GET", payload=payload)
 
             try:
                 response.raise_for_status()
@@ -172,6 +348,131 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
                 return False
             return response.json()
 
+        def process_event(message):
+            """Fetches the activity directly if enabled, otherwise queues the update and reloads the Strava Activities input. Sends the event to Splunk."""
+            aspect_type = message['aspect_type']
+            object_id = message['object_id']
+            object_type = message['object_type']
+            # make owner_id a str to avoid issues with athlete_checkpoint dict
+            owner_id = str(message['owner_id'])
+
+            # With direct fetch, new and updated activities are fetched once their events have settled. The input is the fallback when that fails.
+            direct = direct_fetch and object_type == 'activity' and aspect_type in ('create', 'update')
+            if direct:
+                schedule_fetch(owner_id, object_id, aspect_type == 'update')
+
+            # We only care about activity updates. New activities are pulled in automatically as strava_api input restarts.
+            # Repeated edits of the same activity update the same document, so it's only fetched once.
+            if not direct and aspect_type == 'update' and object_type == 'activity':
+                webhook_updates.add(owner_id, object_id)
+                helper.log_debug(f'Queued update of activity {object_id} for athlete {owner_id}.')
+
+            # Send data to Splunk, workers share the event writer
+            data = json.dumps(message)
+            event = helper.new_event(source=helper.get_input_type(), index=helper.get_output_index(), sourcetype=helper.get_sourcetype(), data=data)
+            with write_lock:
+                ew.write_event(event)
+            metrics.add('events_written')
+
+            # Reload the athlete's strava_api input to pull in the data unless it's a delete, as the input doesn't do anything with that anyway.
+            if aspect_type != 'delete' and not direct:
+                schedule_reload(owner_id)
+
+        def process_events():
+            """Worker that takes events off the queue, so handling them doesn't delay responses to Strava."""
+            while True:
+                received, message = work_queue.get()
+                try:
+                    with metrics.time('process'):
+                        process_event(message)
+                    helper.log_debug(f'Processed webhook event {(time.time() - received) * 1000:.1f} ms after receiving it, queue depth {work_queue.qsize()}.')
+                except Exception as ex:
+                    helper.log_error(f'Something went wrong processing webhook event {message}: {ex}')
+                finally:
+                    work_queue.task_done()
+
+        def reload_athletes():
+            """Reloads the inputs of athletes whose updates have settled, runs in its own thread."""
+            while True:
+                time.sleep(1)
+                now = time.time()
+                with reload_lock:
+                    due = [owner_id for owner_id, (first_seen, last_seen) in pending_reloads.items() if now - last_seen >= reload_delay or now - first_seen >= reload_delay * 6]
+                    for owner_id in due:
+                        del pending_reloads[owner_id]
+                for owner_id in due:
+                    try:
+                        restart_input('strava_api', helper.context_meta['session_key'], (find_input(owner_id) or {}).get('name'))
+                    except Exception as ex:
+                        helper.log_error(f'Something went wrong reloading input for athlete {owner_id}: {ex}')
+
+        def restart_input(modinput, session_key, stanza=None):
+            """Restarts modinput, or only its stanza if given. Used to trigger the Strava Activities input to pull in update."""
+            if stanza:
+                rest_url = f'https://localhost:8089/servicesNS/nobody/TA-strava-for-splunk/data/inputs/{modinput}/{quote(stanza, safe="")}/_reload'
+            else:
+                rest_url = f'https://localhost:8089/services/data/inputs/{modinput}/_reload'
+            headers = {'Authorization': f'Splunk {session_key}'}
+
+            response = http_client.send_http_request(rest_url, "GET", headers=headers, verify=False)
+            try:
+                response.raise_for_status()
+            except Exception as ex:
+                helper.log_error(f'Something went wrong in input function: {ex}')
+                return
+            metrics.add('input_reloads')
+            helper.log_info(f'Reloaded Strava API input {stanza or "(all inputs)"} to retrieve updated activities.')
+
+        def schedule_fetch(owner_id, activity_id, updated):
+            """Fetches the activity once no new events came in for it for FETCH_DELAY seconds, so a burst of edits causes a single fetch."""
+            now = time.time()
+            with fetch_lock:
+                if (owner_id, activity_id) in pending_fetches:
+                    metrics.add('fetches_coalesced')
+                first_seen, _, was_updated = pending_fetches.get((owner_id, activity_id), (now, now, False))
+                pending_fetches[(owner_id, activity_id)] = (first_seen, now, updated or was_updated)
+            helper.log_debug(f'Fetching activity {activity_id} for athlete {owner_id} in {FETCH_DELAY} seconds.')
+
+        def schedule_reload(owner_id):
+            """Reloads the athlete's input once no new events came in for reload_delay seconds, so a burst of edits causes a single reload."""
+            now = time.time()
+            with reload_lock:
+                first_seen = pending_reloads.get(owner_id, (now, now))[0]
+                pending_reloads[owner_id] = (first_seen, now)
+            helper.log_debug(f'Reloading Strava API input for athlete {owner_id} in {reload_delay} seconds.')
+
+        def strava_request(url, method, token=None, parse=None, **kwargs):
+            """Sends a request to the Strava API within the shared rate limit. Returns the JSON response, or None if not found.
+
+            With parse, the body is passed to parse in chunks as they come in, instead of read as a whole.
+            """
+            # Don't wait for the rate limit, the input gets the activity once the limit has been reset.
+            governor.acquire(max_wait=0)
+            headers = {'Authorization': f'Bearer {token}'} if token else None
+            with metrics.time('api'):
+                response = http_client.send_http_request(url, method, headers=headers, stream=parse is not None, **kwargs)
+            with response:
+                metrics.record_response(method, url, response, streamed=parse is not None)
+                governor.update(response.headers)
+                if response.status_code == 404:
+                    return None
+                response.raise_for_status()
+                if parse is None:
+                    return response.json()
+                with metrics.time('download'):
+                    return parse(counted(response.iter_content(chunk_size=CHUNK_SIZE)))
+
+        def write_metrics():
+            """Writes the metrics of the last METRICS_INTERVAL seconds and starts counting again, runs in its own thread."""
+            while True:
+                time.sleep(METRICS_INTERVAL)
+                event = metrics.event(reset=True, queue_depth=work_queue.qsize())
+                if not event['counters']:
+                    continue
+                event = helper.new_event(source=helper.get_input_type(), index=helper.get_output_index(), sourcetype=METRICS_SOURCETYPE, data=json.dumps(event))
+                with write_lock:
+                    ew.write_event(event)
+
         # Get global arguments
         stanza = list(helper.get_input_stanza())[0]
         dict_port = helper.get_arg('port')
@@ -182,14 +483,65 @@ class StravaWebhook(hsw.STRAVA_WEBHOOK):
         key_file = helper.get_arg('key_file')[stanza]
         client_id = helper.get_global_setting('client_id')
         client_secret = helper.get_global_setting('client_secret')
+        reload_delay = int((helper.get_arg('reload_delay') or {}).get(stanza) or DEFAULT_RELOAD_DELAY)
+        direct_fetch = int((helper.get_arg('direct_fetch') or {}).get(stanza) or 0) == 1
+
+        # Requests to Strava and splunkd reuse pooled connections
+        http_client = HttpClient()
+
+        # Time spent per phase and counters, written as a strava:ta:metrics event every METRICS_INTERVAL seconds
+        metrics = RunMetrics(input=stanza)
+        Thread(target=write_metrics, daemon=True).start()
+
+        # Updated activities for the strava_api inputs to fetch
+        webhook_updates = WebhookUpdates(http_client, helper.context_meta['session_key'], metrics)
+        # Hashes of what was last written for each activity, shared with the strava_api inputs
+        activity_digests = ActivityDigests(http_client, helper.context_meta['session_key'], metrics)
+        # Segments of directly fetched activities, added to the strava_segments lookup
+        segments = Segments(http_client, helper.context_meta['session_key'], metrics)
+
+        # Responses cached by the Strava Activities inputs, dropped for activities that are fetched directly after an update
+        response_cache = None
+        response_cache_size = int(helper.get_global_setting('response_cache_size') or 0)
+        if direct_fetch and response_cache_size:
+            response_cache = ResponseCache(os.path.join(os.path.dirname(helper.context_meta['checkpoint_dir']), 'strava_cache'), response_cache_size * 1024 * 1024)
+
+        # Secrets are read and refreshed tokens stored through splunkd, cached by input name
+        service = client.connect(token=helper.context_meta['session_key'], app='TA-strava-for-splunk')
+        tokens = {}
+        token_lock = Lock()
+        # The rate limit is shared with the Strava Activities inputs, in the same file they use
+        governor = RateLimitGovernor(os.path.join(os.path.dirname(helper.context_meta['checkpoint_dir']), 'strava_rate_limit.json'), helper)
+
+        # Incoming events are queued and handled by background workers
+        work_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        write_lock = Lock()
+        for _ in range(WEBHOOK_WORKERS):
+            Thread(target=process_events, daemon=True).start()
+
+        # Reloads are debounced per athlete, pending_reloads has the first and last time an event came in for each athlete
+        pending_reloads = {}
+        reload_lock = Lock()
+        # Athlete ID to strava_api input entry
+        athlete_inputs = {}
+        Thread(target=reload_athletes, daemon=True).start()
+
+        # Direct fetches are debounced per activity like reloads, pending_fetches has the first and last time an event came in
+        # for each (owner_id, activity_id) and whether one was an update. fetching has the activities being fetched right now.
+        pending_fetches = {}
+        fetching = set()
+        fetch_lock = Lock()
+        fetch_executor = None
+        if direct_fetch:
+            fetch_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS)
+            Thread(target=fetch_activities, daemon=True).start()
 
         # Setup HTTP Server instance
         try:
-            httpd = HTTPServer(('', port), SimpleHTTPRequestHandler)
             sslctx = ssl.SSLContext()
             sslctx.check_hostname = False
             sslctx.load_cert_chain(certfile=cert_file, keyfile=key_file)
-            httpd.socket = sslctx.wrap_socket(httpd.socket, server_side=True)
+            httpd = ThreadingHTTPSServer(('', port), SimpleHTTPRequestHandler, sslctx)
         except Exception as err:
             helper.log_error(err)
             raise
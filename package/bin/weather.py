@@ -1,50 +1,113 @@
 import import_declare_test
 import sys
 import json
+import os
+import time
 import requests
 from urllib.parse import urljoin, urlencode
 
+from splunklib import binding
 from splunklib.searchcommands import dispatch, GeneratingCommand, Configuration, Option
+from strava_cache import ResponseCache
+from strava_kvstore import content_hash
 
 WEATHER_API_URL = 'https://api.openweathermap.org/data/2.5/'
+WEATHER_UNITS = 'metric'
+# Forecasts are kept on disk next to the Strava response cache, shared by all searches
+WEATHER_CACHE_DIR = os.path.join(os.environ.get('SPLUNK_HOME', ''), 'var', 'lib', 'splunk', 'modinputs', 'weather_cache')
+# Defaults for the weather cache settings, in minutes and MB
+DEFAULT_WEATHER_CACHE_TTL = 30
+DEFAULT_WEATHER_CACHE_SIZE = 10
 
 
 def build_weather_api_url(path, query, token, units):
     return urljoin(WEATHER_API_URL, path + "?" + urlencode(dict(q=query, appid=token, units=units)))
 
 
+def get_cache_settings(service):
+    """Returns the weather cache TTL in seconds and size in bytes from the Add-On Settings, or the defaults."""
+    try:
+        settings = service.confs['ta_strava_for_splunk_settings']['additional_parameters'].content
+    except (KeyError, binding.HTTPError):
+        # Not configured, or the user running the search isn't allowed to read the add-on's settings
+        settings = {}
+    ttl = int(settings.get('weather_cache_ttl') or DEFAULT_WEATHER_CACHE_TTL) * 60
+    size = int(settings.get('weather_cache_size') or DEFAULT_WEATHER_CACHE_SIZE) * 1024 * 1024
+    return ttl, size
+
+
 def get_encrypted_weather_api_token(search_command):
-    secrets = search_command.service.storage_passwords
-    for secret in secrets:
-        if 'openweathermap_apikey' in secret.clear_password:
-            dict_secret = json.loads(secret.clear_password)
-            api_key = dict_secret['openweathermap_apikey']
-    return api_key
+    """Returns the OpenWeatherMap API key from the add-on's secrets, looked up once per search."""
+    if search_command.api_key is None:
+        secrets = search_command.service.storage_passwords
+        for secret in secrets:
+            if 'openweathermap_apikey' in secret.clear_password:
+                dict_secret = json.loads(secret.clear_password)
+                search_command.api_key = dict_secret['openweathermap_apikey']
+                break
+    return search_command.api_key
+
+
+def location_key(location, units):
+    """Returns the cache key of a forecast, the same for locations that only differ in case and whitespace."""
+    return f"weather-{content_hash([' '.join(location.lower().split()), units])}"
 
 
 @Configuration()
 class WeatherSearch(GeneratingCommand):
     location = Option(require=True)
+    api_key = None
+
+    def get_forecast(self):
+        """Returns the forecast for the location from the cache if it's recent enough, otherwise from OpenWeatherMap.
+
+        Forecasts are cached with the TTL of the moment they were fetched, so a cache hit doesn't have to read the
+        cache settings from splunkd.
+        """
+        cache = None
+        key = location_key(self.location, WEATHER_UNITS)
+        try:
+            cache = ResponseCache(WEATHER_CACHE_DIR, DEFAULT_WEATHER_CACHE_SIZE * 1024 * 1024)
+        except OSError as ex:
+            self.logger.warning(f'Weather cache not available: {ex}')
+        if cache:
+            cached = cache.get(key)
+            if cached and time.time() < cached.get('expires', 0):
+                self.logger.info(f'Weather cache hit for location "{self.location}", fetched {time.time() - cached["fetched"]:.0f} seconds ago.')
+                return cached['response']
+            self.logger.info(f'Weather cache miss for location "{self.location}".')
 
-    def generate(self):
         token = get_encrypted_weather_api_token(self)
         if token is None:
             raise ValueError('No OpenWeatherMap API key found. Please add one and try again.')
 
         # call out to the weather API
-        url = build_weather_api_url('forecast', self.location, token, 'metric')
+        url = build_weather_api_url('forecast', self.location, token, WEATHER_UNITS)
 
         # make request
         response = requests.get(url, timeout=10)
+        response.raise_for_status()
+        forecast = response.json()
 
+        ttl, size = get_cache_settings(self.service)
+        if cache and ttl and size:
+            cache.max_bytes = size
+            fetched = time.time()
+            try:
+                cache.put(key, {'fetched': fetched, 'expires': fetched + ttl, 'response': forecast})
+            except OSError as ex:
+                self.logger.warning(f'Could not cache the weather for location "{self.location}": {ex}')
+        return forecast
+
+    def generate(self):
         try:
-            response.raise_for_status()
+            forecast = self.get_forecast()
         except requests.exceptions.HTTPError as ex:
             return f'Error: {ex}'
 
-        result = response.json()['list'][0]
-        lat = response.json()['city']['coord']['lat']
-        lon = response.json()['city']['coord']['lon']
+        result = forecast['list'][0]
+        lat = forecast['city']['coord']['lat']
+        lon = forecast['city']['coord']['lon']
         message = {
             'time': result['dt_txt'],
             'temperature_c': result['main']['temp'],
@@ -0,0 +1,209 @@
+import import_declare_test
+import sys
+import collections
+import concurrent.futures
+import datetime
+import threading
+import time
+import requests
+from urllib.parse import urlencode
+
+from splunklib.searchcommands import dispatch, StreamingCommand, Configuration, Option, validators
+from strava_cache import ResponseCache
+from strava_kvstore import content_hash
+from weather import WEATHER_CACHE_DIR, WEATHER_UNITS, get_cache_settings, get_encrypted_weather_api_token
+
+# Historical weather by coordinates and time, requires a One Call API 3.0 subscription
+WEATHER_HISTORY_URL = 'https://api.openweathermap.org/data/3.0/onecall/timemachine'
+# Records read ahead of the one being returned while their weather is fetched
+MAX_PENDING = 1000
+# Attempts per lookup when OpenWeatherMap says the rate limit was hit
+MAX_ATTEMPTS = 3
+
+
+class RateLimiter:
+    """Spaces out requests from all worker threads to at most per_minute requests a minute."""
+
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute
+        self.lock = threading.Lock()
+        self.next_request = 0
+
+    def wait(self):
+        """Sleeps until the next request is allowed."""
+        with self.lock:
+            now = time.monotonic()
+            request_at = max(now, self.next_request)
+            self.next_request = request_at + self.interval
+        time.sleep(request_at - now)
+
+
+def get_epoch(value):
+    """Returns an epoch timestamp for an epoch or ISO 8601 value like Strava's start_date, or None."""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        timestamp = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return int(timestamp.timestamp())
+
+
+@Configuration(distributed=False)
+class WeatherEnrichCommand(StreamingCommand):
+    """Adds the historical weather at the location and time of every record, e.g. the start of each activity.
+
+    Records are looked up by their coordinates rounded to `precision` decimals and their time in buckets of `bucket`
+    seconds, so activities starting close to each other share a lookup. Lookups are remembered for the whole search and,
+    once their time bucket is over, kept in the weather cache on disk.
+    """
+    latlng = Option(default='start_latlng{}')
+    lat = Option()
+    lon = Option()
+    time = Option(default='_time')
+    precision = Option(default=1, validate=validators.Integer(minimum=0, maximum=4))
+    bucket = Option(default=3600, validate=validators.Integer(minimum=60))
+    workers = Option(default=4, validate=validators.Integer(minimum=1, maximum=16))
+    rate = Option(default=60, validate=validators.Integer(minimum=1))
+    api_key = None
+
+    def __init__(self):
+        super().__init__()
+        self.cache = None
+        self.executor = None
+        self.lookups = {}
+        self.rate_limiter = None
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()
+
+    def count(self, stat):
+        """Counts a lookup by how it was answered, from any worker thread."""
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def fetch_weather(self, lat, lon, epoch):
+        """Gets the weather for a rounded location and time bucket from the cache or OpenWeatherMap, runs in a worker thread."""
+        key = f'weatherenrich-{content_hash([lat, lon, epoch, WEATHER_UNITS])}'
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.count('cache_hits')
+                return cached
+
+        params = {'lat': lat, 'lon': lon, 'dt': epoch, 'appid': self.api_key, 'units': WEATHER_UNITS}
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.rate_limiter.wait()
+            try:
+                response = requests.get(f'{WEATHER_HISTORY_URL}?{urlencode(params)}', timeout=10)
+            except requests.RequestException as ex:
+                # One lookup failing shouldn't fail the whole search
+                self.logger.warning(f'No weather for {lat},{lon} at {epoch}: {ex}')
+                self.count('errors')
+                return {}
+            self.count('api_calls')
+            if response.status_code != 429 or attempt == MAX_ATTEMPTS:
+                break
+            time.sleep(int(response.headers.get('Retry-After') or 2 ** attempt))
+        if response.status_code in (401, 403):
+            raise ValueError('OpenWeatherMap refused the API key. Historical weather requires a One Call API 3.0 subscription.')
+        if not response.ok:
+            self.logger.warning(f'No weather for {lat},{lon} at {epoch}: {response.status_code} {response.reason}')
+            self.count('errors')
+            return {}
+
+        try:
+            data = response.json()['data'][0]
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.logger.warning(f'No weather for {lat},{lon} at {epoch}: unexpected response from OpenWeatherMap.')
+            self.count('errors')
+            return {}
+        weather = {
+            'weather_time': data['dt'],
+            'weather_temperature_c': data['temp'],
+            'weather_temperature_f': round(data['temp'] * 1.8 + 32, 2),
+            'weather_humidity': data.get('humidity'),
+            'weather_wind_degrees': data.get('wind_deg'),
+            'weather_wind_speed_kph': round(data.get('wind_speed', 0) * 3.6, 2),
+            'weather_wind_speed_mph': round(data.get('wind_speed', 0) * 2.23694, 2),
+            'weather_description': data['weather'][0]['description'] if data.get('weather') else None,
+        }
+        # The weather of a time bucket that isn't over yet can still change
+        if self.cache and epoch + self.bucket < time.time():
+            try:
+                self.cache.put(key, weather)
+            except OSError as ex:
+                self.logger.warning(f'Could not cache the weather for {lat},{lon} at {epoch}: {ex}')
+        return weather
+
+    def get_location(self, record):
+        """Returns the latitude and longitude of a record from the lat and lon fields, or the latlng field."""
+        if self.lat and self.lon:
+            lat, lon = record.get(self.lat), record.get(self.lon)
+        else:
+            latlng = record.get(self.latlng)
+            if not isinstance(latlng, list) or len(latlng) != 2:
+                return None
+            lat, lon = latlng
+        try:
+            return round(float(lat), self.precision), round(float(lon), self.precision)
+        except (TypeError, ValueError):
+            return None
+
+    def lookup(self, record):
+        """Returns the future weather of a record, shared with all records of the same rounded location and time bucket."""
+        location = self.get_location(record)
+        epoch = get_epoch(record.get(self.time))
+        if location is None or epoch is None:
+            return None
+        key = (*location, epoch - epoch % self.bucket)
+        if key in self.lookups:
+            self.count('memoized')
+        else:
+            self.lookups[key] = self.executor.submit(self.fetch_weather, *key)
+        return self.lookups[key]
+
+    def prepare(self):
+        if bool(self.lat) != bool(self.lon):
+            raise ValueError('Set both lat and lon, or neither to use latlng.')
+
+    def stream(self, records):
+        # Set up once, the same instance handles every chunk of the search
+        if self.executor is None:
+            if get_encrypted_weather_api_token(self) is None:
+                raise ValueError('No OpenWeatherMap API key found. Please add one and try again.')
+            _, size = get_cache_settings(self.service)
+            if size:
+                try:
+                    self.cache = ResponseCache(WEATHER_CACHE_DIR, size)
+                except OSError as ex:
+                    self.logger.warning(f'Weather cache not available: {ex}')
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            self.rate_limiter = RateLimiter(self.rate)
+
+        # Records are returned in order as soon as their weather is in, with at most MAX_PENDING records waiting
+        pending = collections.deque()
+        count = 0
+        for record in records:
+            pending.append((record, self.lookup(record)))
+            count += 1
+            if len(pending) >= MAX_PENDING:
+                yield self.enrich(*pending.popleft())
+        while pending:
+            yield self.enrich(*pending.popleft())
+
+        self.logger.info(f'Weather for {count} records: {len(self.lookups)} lookups so far, {self.stats["memoized"]} shared, '
+                         f'{self.stats["cache_hits"]} from the weather cache, {self.stats["api_calls"]} OpenWeatherMap calls, {self.stats["errors"]} errors.')
+
+    @staticmethod
+    def enrich(record, future):
+        """Adds the weather to a record once it has been fetched."""
+        if future is not None:
+            record.update(future.result())
+        return record
+
+
+dispatch(WeatherEnrichCommand, sys.argv, sys.stdin, sys.stdout, __name__)